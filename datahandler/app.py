@@ -6,11 +6,13 @@ import os
 import sys
 import time
 
-from knowledge import knowledge_routes, sync
+from knowledge import knowledge_routes, sync_tree
 from opensearch import get_opensearch
 from auth import *
 from wiki import wiki_routes
 from outlinesr import outlines_routes
+from watcher import watcher_routes, start_watcher
+from jobs import job_routes
 
 from config import *
 
@@ -20,6 +22,8 @@ auth_routes(app)
 wiki_routes(app)
 knowledge_routes(app)
 outlines_routes(app)
+watcher_routes(app)
+job_routes(app)
 
 @app.route('/')
 def explorer():
@@ -30,11 +34,10 @@ if __name__ == '__main__':
     
     time.sleep(10) # docker depend-on isnt waiting for the api to be ready
     print('Trying to authenticate')
-    print(auth())
-    while get_api() is None:
-        print('Trying to authenticate')
-        print(auth())
+    # auth() is None until we hold a token, after that it is cached and kept fresh in the background
+    while auth() is None:
         time.sleep(5)
+        print('Trying to authenticate')
     time.sleep(1)
 
     # make sure opensearch is ready
@@ -47,25 +50,17 @@ if __name__ == '__main__':
         print('Syncing wiki')
        # print(sync_wiki())
         print('Syncing root')
-        files = []
         if not os.path.exists(BASE_DIRECTORY):
             print(f"Base directory '{BASE_DIRECTORY}' does not exist. Creating it.", file=sys.stderr)
             os.makedirs(BASE_DIRECTORY)
         if not os.path.exists(WIKI_DIR):
             print(f"Wiki directory '{WIKI_DIR}' does not exist. Creating it.", file=sys.stderr)
             os.makedirs(WIKI_DIR)
-        
-        directories = [BASE_DIRECTORY]
+        print(sync_tree(BASE_DIRECTORY), file=sys.stderr)
 
-        while directories:
-            current_directory = directories.pop()
-            for entry in os.listdir(current_directory):
-                full_path = os.path.join(current_directory, entry)
-                if os.path.isdir(full_path):
-                    directories.append(full_path)
-                else:
-                    files.append(full_path)
-        print(files, file=sys.stderr)
-        sync('Default', files)
+    # keep knowledge bases up to date as files change
+    if WATCH_FILES:
+        print('Watching ' + BASE_DIRECTORY)
+        start_watcher()
 
     app.run(host='0.0.0.0', port=os.getenv('FLASK_PORT', 5000))
\ No newline at end of file
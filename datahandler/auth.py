@@ -1,6 +1,10 @@
 from flask import jsonify, request
-import requests
+import client
 import os
+import json
+import base64
+import threading
+import time
 from config import *
 from auth import *
 
@@ -8,15 +12,81 @@ import sys
 
 global current_token
 current_token = None
+# when current_token runs out, None if it doesn't say
+token_expiry = None
+# only one thread logs in again at a time, the rest wait for its token
+refresh_lock = threading.RLock()
+refresher = None
 
 
 def auth_header():
     return {
         'accept': 'application/json',
         'Content-Type': 'application/json',
-        'Authorization': 'Bearer ' + current_token
+        'Authorization': bearer()
     }
 
+def bearer():
+    """The Authorization value for the cached token, logging in first if there is none or it is about to run out."""
+    if current_token is None or expiring():
+        auth()
+    return 'Bearer ' + str(current_token)
+
+def decode_expiry(token):
+    """The exp claim of a JWT, read without verifying it, None if there isn't one."""
+    try:
+        payload = token.split('.')[1]
+        payload += '=' * (-len(payload) % 4)
+        exp = json.loads(base64.urlsafe_b64decode(payload)).get('exp')
+        return float(exp) if exp is not None else None
+    except (IndexError, ValueError, AttributeError):
+        return None
+
+def set_token(token):
+    global current_token, token_expiry
+    current_token = token
+    token_expiry = decode_expiry(token)
+    if token_expiry is not None:
+        start_refresher()
+
+def expiring():
+    return token_expiry is not None and time.time() >= token_expiry - AUTH_REFRESH_AHEAD
+
+def refresh(stale=None):
+    """
+    Log in again, unless another thread already replaced the stale token while we waited for the lock.
+    Returns the Authorization value to use.
+    """
+    with refresh_lock:
+        if current_token is not None and 'Bearer ' + current_token != stale and not expiring():
+            return 'Bearer ' + current_token
+        authenticate()
+    return 'Bearer ' + str(current_token)
+
+def refresh_unauthorized(authorization):
+    """Called by the client on a 401, only a token we handed out is worth refreshing."""
+    if current_token is None or not authorization.startswith('Bearer '):
+        return None
+    return refresh(authorization)
+
+client.on_unauthorized = refresh_unauthorized
+
+def start_refresher():
+    """Log in again ahead of the token running out, so requests never wait on it."""
+    global refresher
+    with refresh_lock:
+        if refresher is not None:
+            return
+        refresher = threading.Thread(target=refresh_loop, daemon=True)
+    refresher.start()
+
+def refresh_loop():
+    while True:
+        wait = 60 if token_expiry is None else token_expiry - AUTH_REFRESH_AHEAD - time.time()
+        time.sleep(max(5, wait))
+        if expiring():
+            refresh('Bearer ' + str(current_token))
+
 HEADERS = {
         'accept': 'application/json',
         'Content-Type': 'application/json'
@@ -32,9 +102,8 @@ def login():
     }
     
     try:
-        response = requests.post(url, headers=HEADERS, json=data)
-        global current_token
-        current_token = response.json()["token"]
+        response = client.post(url, headers=HEADERS, json=data, idempotent=True)
+        set_token(response.json()["token"])
         return response.json()
 
     except Exception as err:
@@ -43,11 +112,20 @@ def login():
     
     
 def auth():
-    # if we have a valid token, return it
-    global current_token
-    if current_token is not None and get_api() is not None:
+    # if we have a token that isn't about to run out, return it
+    # a token that stopped working is caught by the 401 it gets, no need to check it here
+    if current_token is not None and not expiring():
         return {"token": current_token}
-    
+
+    with refresh_lock:
+        if current_token is not None and not expiring():
+            return {"token": current_token}
+        result = authenticate()
+        if current_token is None:
+            return None
+        return result
+
+def authenticate():
     # get session -> if not exist -> login -> if not exist -> signup
     session_data = session()
     if session_data is None:
@@ -70,7 +148,7 @@ def signup():
     }
 
     try:
-        response = requests.post(url, headers=HEADERS, json=data)
+        response = client.post(url, headers=HEADERS, json=data)
         return login()
     except Exception as err:
         print(err, file=sys.stderr)
@@ -81,7 +159,7 @@ def get_api():
     url = BASE_URL + 'auths/api_key'
 
     try:
-        response = requests.get(url, headers=auth_header())
+        response = client.get(url, headers=auth_header())
         return response.json()
     except Exception as err:
         print(err, file=sys.stderr)
@@ -91,7 +169,7 @@ def session():
     url = BASE_URL + 'auths/'
 
     try:
-        response = requests.get(url, headers=HEADERS)
+        response = client.get(url, headers=HEADERS)
         if response.json()["detail"] == "Not authenticated":
             return None
         
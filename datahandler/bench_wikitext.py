@@ -0,0 +1,247 @@
+"""
+Micro-benchmark for format_wikitext against the renderer it replaced.
+
+    python bench_wikitext.py [--repeat N] [--markdown] [article.wiki ...]
+
+Without files a fixed set of large generated articles is used, so runs are comparable between machines.
+Both renderers must produce identical html for every article, the script fails if they don't.
+The visitor is a restructuring rather than a speedup: mwparserfromhell's parse is nearly all of the time and
+rendering alone comes out within about 10% either way, so this mostly shows nothing got slower.
+
+With --markdown it checks format_markdown against html_to_markdown(format_wikitext(...)) instead,
+the two must agree up to trailing whitespace and runs of blank lines, and times both.
+test_markdown.py runs the same check on the articles in samples/.
+"""
+import argparse
+import gc
+import random
+import re
+import sys
+import time
+from html import escape
+
+import mwparserfromhell
+
+from wiki import format_wikitext, render_wikicode, format_markdown, html_to_markdown
+
+
+def legacy_format_wikitext(wikitext):
+    """
+    format_wikitext as it was before the visitor, string concatenation and name dispatch.
+    """
+    # Parse the wikitext
+    wikicode = mwparserfromhell.parse(wikitext)
+    html_output = legacy_render_wikicode(wikicode)
+    if html_output == "":
+        return "No content found"
+    return html_output
+
+def legacy_render_wikicode(wikicode):
+    # Convert the parsed wikitext to HTML
+    html_output = ""
+    for node in wikicode.nodes:
+        node_type = node.__class__.__name__
+
+        if node_type == "Text":
+            html_output += escape(str(node))
+        elif node_type == "Template":
+            # ignore templates for now
+            continue
+            # html_output += f"<span class='template'>{escape(str(node))}</span>"
+        elif node_type == "Wikilink":
+            target = escape(str(node.title))
+            text = escape(str(node.text)) if node.text else target
+
+            if '|' in text:
+                text = text.split('|')[-1]
+            
+            if 'thumb' in text.split('|')[0]:
+                # handle links [[]] in the 
+                for link in re.findall(r'\[\[(.*?)\]\]', text):
+                    # if there are any links inside the link text, we need to handle them
+                    text = text.replace(link, f"<a class='wikilink' href='/wiki/{link}'>{link}</a>")
+
+                html_output += f"<a class='img' href='/wiki/{target}'>🖼️</a> {text}"
+
+            else:
+                html_output += f"<a class='wikilink' href='/wiki/{target}'>{text}</a>"
+        elif node_type == "ExternalLink":
+            url = escape(str(node.url))
+            text = escape(str(node.title)) if node.title else url
+            html_output += f"<a class='external' href='{url}'>{text}</a>"
+        elif node_type == "Heading":
+            level = node.level
+            heading_text = escape(str(node.title.strip_code()))
+            html_output += f"<h{level}>{heading_text}</h{level}>"
+        elif node_type == "Tag":
+            if node.tag == "ref":
+                # Parse the content inside the <ref> tag
+                ref_content = str(node.contents.strip_code())
+                citation_html = ""
+
+                # Check if the content is a citation template
+                if ref_content.startswith("{{cite"):
+                    # Extract citation fields
+                    fields = {}
+                    for part in ref_content.strip("{}").split("|"):
+                        if "=" in part:
+                            key, value = part.split("=", 1)
+                            fields[key.strip()] = value.strip()
+
+                    # Build the citation HTML
+                    url = fields.get("url", "")
+                    title = fields.get("title", "Untitled")
+                    author = f"{fields.get('first', '')} {fields.get('last', '')}".strip()
+                    date = fields.get("date", "")
+                    website = fields.get("website", "")
+
+                    citation_html = f"<cite>"
+                    if url:
+                        citation_html += f"<a class='cite' href='{escape(url)}'>{escape(title)}</a>"
+                    else:
+                        citation_html += escape(title)
+                    if author:
+                        citation_html += f" by {escape(author)}"
+                    if date:
+                        citation_html += f", {escape(date)}"
+                    if website:
+                        citation_html += f" ({escape(website)})"
+                    citation_html += f"</cite>"
+                else:
+                    # If not a citation template, output raw content
+                    citation_html = escape(ref_content)
+
+                # Wrap the citation in a reference span
+                html_output += f" <sub class='reference'>{citation_html}</sub>"
+            else:
+                html_output += escape(str(node))
+        elif node_type == "Bold":
+            bold_text = escape(str(node.strip_code()))
+            html_output += f"<b>{bold_text}</b>"
+        elif node_type == "Italic":
+            html_output += f"<i>{escape(str(node))}</i>"
+        elif node_type == "File":
+            file_name = escape(str(node.title))
+            finaltext = file_name.split('|')[-1]
+            # handle links [[]] in the 
+            for link in re.findall(r'\[\[(.*?)\]\]', finaltext):
+                # if there are any links inside the link text, we need to handle them
+                finaltext = finaltext.replace(link, f"<a class='wikilink' href='/wiki/{link}'>{link}</a>")
+            html_output += f"<ins>{finaltext}</ins>"
+        else:
+            html_output += escape(str(node))
+
+    return html_output
+
+
+def sample_article(seed, sections=60, paragraphs=6):
+    """A big article with a bit of everything format_wikitext handles, the same every time for a given seed."""
+    rng = random.Random(seed)
+    words = ['alpha', 'beta', 'gamma', 'delta', 'river', 'empire', 'protein', 'orbit', 'treaty', 'album', '<b>&amp;</b>']
+    def sentence():
+        return ' '.join(rng.choice(words) for _ in range(rng.randint(8, 20))) + '. '
+    parts = ['{{Infobox thing|name=Sample ' + str(seed) + '|size=' + str(rng.randint(1, 99)) + '}}\n']
+    for s in range(sections):
+        level = '=' * rng.randint(2, 4)
+        parts.append('\n' + level + ' Section ' + str(s) + ' ' + level + '\n')
+        for _ in range(paragraphs):
+            parts.append(sentence())
+            parts.append('[[' + rng.choice(words).title() + ']] ')
+            parts.append('[[' + rng.choice(words).title() + '|' + rng.choice(words) + ']] ')
+            parts.append("'''" + rng.choice(words) + "''' and ''" + rng.choice(words) + "'' ")
+            parts.append(sentence())
+            parts.append('<ref>{{cite web|url=https://example.org/' + str(rng.randint(0, 9999)) + '|title=' + sentence()
+                         + '|first=Ann|last=Author|date=2020|website=Example}}</ref>')
+            parts.append('[https://example.com/' + str(rng.randint(0, 9999)) + ' external] ')
+            parts.append('<ref>plain reference ' + rng.choice(words) + '</ref>')
+            if rng.random() < 0.2:
+                parts.append('[[File:Picture' + str(rng.randint(0, 99)) + '.jpg|thumb|A [[Caption]] here]]\n')
+            parts.append('{{citation needed}}\n\n')
+    return ''.join(parts)
+
+def bench(fn, articles, repeat):
+    """Best time over repeat runs of rendering every article."""
+    best = None
+    # collections in the middle of a run are most of the noise, as in timeit
+    gc.disable()
+    try:
+        for _ in range(repeat):
+            start = time.perf_counter()
+            for article in articles:
+                fn(article)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+    finally:
+        gc.enable()
+    return best
+
+def normalize_markdown(markdown):
+    """Markdown without trailing whitespace on its lines or more than one blank line in a row."""
+    markdown = '\n'.join(line.rstrip() for line in markdown.strip().split('\n'))
+    return re.sub(r'\n{3,}', '\n\n', markdown)
+
+def two_step_markdown(wikitext):
+    return html_to_markdown(format_wikitext(wikitext), 'Title')
+
+def one_pass_markdown(wikitext):
+    return format_markdown(wikitext, 'Title')
+
+def check_markdown(articles, repeat):
+    failed = 0
+    for i, article in enumerate(articles):
+        expected = normalize_markdown(two_step_markdown(article))
+        actual = normalize_markdown(one_pass_markdown(article))
+        if expected != actual:
+            # show where they part ways
+            at = next((j for j, (a, b) in enumerate(zip(expected, actual)) if a != b), min(len(expected), len(actual)))
+            print('Markdown differs for article ' + str(i) + ' at ' + str(at), file=sys.stderr)
+            print('  html2text: ' + repr(expected[max(0, at - 60):at + 60]), file=sys.stderr)
+            print('  native:    ' + repr(actual[max(0, at - 60):at + 60]), file=sys.stderr)
+            failed += 1
+    if failed:
+        sys.exit(1)
+
+    size = sum(len(article) for article in articles)
+    two_step = bench(two_step_markdown, articles, repeat)
+    one_pass = bench(one_pass_markdown, articles, repeat)
+    print(f'{len(articles)} articles, {size / 1024 / 1024:.1f} MB of wikitext, best of {repeat}, markdown matches')
+    print(f'html + html2text {two_step * 1000:9.1f} ms')
+    print(f'native markdown  {one_pass * 1000:9.1f} ms')
+    print(f'speedup          {two_step / one_pass:9.2f}x')
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark format_wikitext against the legacy renderer.')
+    parser.add_argument('files', nargs='*', help='wikitext files to render instead of the generated samples')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--markdown', action='store_true', help='check and time the markdown renderer instead')
+    args = parser.parse_args()
+
+    if args.files:
+        articles = [open(path, encoding='utf-8').read() for path in args.files]
+    else:
+        articles = [sample_article(seed) for seed in range(8)]
+
+    if args.markdown:
+        check_markdown(articles, args.repeat)
+        return
+
+    for i, article in enumerate(articles):
+        if legacy_format_wikitext(article) != format_wikitext(article):
+            print('Output differs for article ' + str(i), file=sys.stderr)
+            sys.exit(1)
+
+    size = sum(len(article) for article in articles)
+    parsed = [mwparserfromhell.parse(article) for article in articles]
+    legacy = bench(legacy_format_wikitext, articles, args.repeat)
+    current = bench(format_wikitext, articles, args.repeat)
+    # both parse the same way, rendering already parsed articles shows what the renderer itself costs
+    legacy_render = bench(legacy_render_wikicode, parsed, args.repeat)
+    current_render = bench(render_wikicode, parsed, args.repeat)
+    print(f'{len(articles)} articles, {size / 1024 / 1024:.1f} MB of wikitext, best of {args.repeat}')
+    print(f'             overall    rendering')
+    print(f'legacy   {legacy * 1000:9.1f} ms {legacy_render * 1000:9.1f} ms')
+    print(f'visitor  {current * 1000:9.1f} ms {current_render * 1000:9.1f} ms')
+    print(f'speedup  {legacy / current:9.2f}x   {legacy_render / current_render:9.2f}x')
+
+if __name__ == '__main__':
+    main()
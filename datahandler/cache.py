@@ -0,0 +1,150 @@
+import gzip
+import hashlib
+import os
+import shutil
+import sys
+import threading
+from collections import OrderedDict
+
+
+class LRUCache:
+    """
+    Least recently used cache bounded by the total size of its values in bytes, not the number of entries.
+    sizeof is called on each value to measure it.
+    """
+
+    def __init__(self, max_bytes, sizeof=sys.getsizeof):
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.entries = OrderedDict()  # key -> (value, size)
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value):
+        size = self.sizeof(value)
+        with self.lock:
+            if key in self.entries:
+                self.bytes -= self.entries.pop(key)[1]
+            if size > self.max_bytes:
+                # would evict everything else and still not fit, don't bother
+                return
+            self.entries[key] = (value, size)
+            self.bytes += size
+            self._evict()
+
+    def resize(self, key):
+        """Re-measure an entry whose value has changed size since it was put."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return
+            size = self.sizeof(entry[0])
+            self.entries[key] = (entry[0], size)
+            self.bytes += size - entry[1]
+            self._evict()
+
+    def _evict(self):
+        while self.bytes > self.max_bytes and self.entries:
+            _, (_, size) = self.entries.popitem(last=False)
+            self.bytes -= size
+            self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+
+    def stats(self):
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'bytes': self.bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+
+class RenderCache:
+    """
+    Rendered text kept in memory in front of gzipped files on disk, so it survives restarts.
+    Everything is stored under a version, moving to a new version drops the old one from memory and disk.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.memory = LRUCache(max_bytes)
+        self.version = None
+        self.disk_hits = 0
+        self.disk_misses = 0
+        self.lock = threading.Lock()
+
+    def set_version(self, version):
+        with self.lock:
+            if version == self.version:
+                return
+            self.version = version
+        self.memory.clear()
+        if os.path.isdir(self.directory):
+            for name in os.listdir(self.directory):
+                if name != version:
+                    shutil.rmtree(os.path.join(self.directory, name), ignore_errors=True)
+
+    def path(self, version, key):
+        # spread the files over a few hundred directories
+        shard = hashlib.md5(key.encode()).hexdigest()[:2]
+        return os.path.join(self.directory, version, shard, key + '.gz')
+
+    def get(self, version, key):
+        self.set_version(version)
+        value = self.memory.get((version, key))
+        if value is not None:
+            return value
+        try:
+            with gzip.open(self.path(version, key), 'rt', encoding='utf-8') as f:
+                value = f.read()
+        except FileNotFoundError:
+            self.disk_misses += 1
+            return None
+        except (OSError, EOFError) as err:
+            print(err, file=sys.stderr)
+            self.disk_misses += 1
+            return None
+        self.disk_hits += 1
+        self.memory.put((version, key), value)
+        return value
+
+    def put(self, version, key, value):
+        self.set_version(version)
+        self.memory.put((version, key), value)
+        path = self.path(version, key)
+        tmp = path + '.' + str(os.getpid()) + '.' + str(threading.get_ident())
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with gzip.open(tmp, 'wt', encoding='utf-8', compresslevel=6) as f:
+                f.write(value)
+            # readers never see a half written file
+            os.replace(tmp, path)
+        except OSError as err:
+            print('Failed to cache ' + key + ': ' + str(err), file=sys.stderr)
+
+    def stats(self):
+        stats = self.memory.stats()
+        stats['version'] = self.version
+        stats['disk_hits'] = self.disk_hits
+        stats['disk_misses'] = self.disk_misses
+        return stats
@@ -0,0 +1,114 @@
+import gzip
+import os
+import random
+import sys
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from config import *
+
+# safe to send again if the first attempt may or may not have landed
+IDEMPOTENT = {'GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'}
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+sessions = {}
+lock = threading.Lock()
+
+# called with the Authorization header of a request that got a 401, returns the one to try again with, or None
+on_unauthorized = None
+
+def get_session(url):
+    """
+    One keep-alive session per host, shared by every thread.
+    Keyed on the process too, a forked render worker must not reuse its parent's sockets.
+    """
+    parts = urlsplit(url)
+    key = (os.getpid(), parts.scheme, parts.netloc)
+    session = sessions.get(key)
+    if session is None:
+        with lock:
+            session = sessions.get(key)
+            if session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=HTTP_POOL_SIZE)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                sessions[key] = session
+    return session
+
+def backoff(attempt, response=None):
+    """Seconds to wait before the next attempt, full jitter on an exponential cap, or what Retry-After asks for."""
+    if response is not None:
+        try:
+            return min(HTTP_BACKOFF_MAX, float(response.headers.get('Retry-After')))
+        except (TypeError, ValueError):
+            pass
+    return random.uniform(0, min(HTTP_BACKOFF_MAX, HTTP_BACKOFF * 2 ** attempt))
+
+def request(method, url, retries=HTTP_RETRIES, idempotent=None, compress=False, timeout=None, **kwargs):
+    """
+    Send a request on the host's pooled session.
+    429 and 5xx responses, and connection errors, are retried with backoff when the request is idempotent,
+    which is every method but POST and PATCH unless the caller says otherwise.
+    compress gzips data before sending it. The last response is returned whatever its status, like requests does.
+    A 401 on a request that carried a token is sent once more with whatever on_unauthorized hands back.
+    """
+    response = send(method, url, retries, idempotent, compress, timeout, **kwargs)
+    authorization = (kwargs.get('headers') or {}).get('Authorization')
+    if response.status_code == 401 and authorization and on_unauthorized is not None:
+        fresh = on_unauthorized(authorization)
+        if fresh and fresh != authorization:
+            kwargs['headers'] = dict(kwargs['headers'], Authorization=fresh)
+            rewind(kwargs)
+            response = send(method, url, retries, idempotent, compress, timeout, **kwargs)
+    return response
+
+def rewind(kwargs):
+    """Put uploaded file objects back at the start so they can be sent again."""
+    for value in (kwargs.get('files') or {}).values():
+        f = value[1] if isinstance(value, tuple) else value
+        if hasattr(f, 'seek'):
+            f.seek(0)
+
+def send(method, url, retries, idempotent, compress, timeout, **kwargs):
+    if idempotent is None:
+        idempotent = method.upper() in IDEMPOTENT
+    if not idempotent:
+        retries = 0
+    if timeout is None:
+        timeout = (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT)
+    if compress and kwargs.get('data') is not None:
+        data = kwargs['data']
+        kwargs['data'] = gzip.compress(data.encode('utf-8') if isinstance(data, str) else data, compresslevel=1)
+        kwargs['headers'] = dict(kwargs.get('headers') or {}, **{'Content-Encoding': 'gzip'})
+
+    session = get_session(url)
+    for attempt in range(retries + 1):
+        try:
+            response = session.request(method, url, timeout=timeout, **kwargs)
+        except (requests.ConnectionError, requests.Timeout) as err:
+            if attempt == retries:
+                raise
+            print('Retrying ' + method + ' ' + url + ' after ' + str(err), file=sys.stderr)
+            time.sleep(backoff(attempt))
+            continue
+        if response.status_code not in RETRY_STATUS or attempt == retries:
+            return response
+        time.sleep(backoff(attempt, response))
+    return response
+
+def get(url, **kwargs):
+    return request('GET', url, **kwargs)
+
+def post(url, **kwargs):
+    return request('POST', url, **kwargs)
+
+def put(url, **kwargs):
+    return request('PUT', url, **kwargs)
+
+def delete(url, **kwargs):
+    return request('DELETE', url, **kwargs)
@@ -7,6 +7,87 @@ WIKI_DIR = '/app/data/wiki/'
 WIKI_URL = 'https://dumps.wikimedia.org/enwiki/latest/enwiki-latest-pages-articles-multistream.xml.bz2'
 INDEX = 'https://dumps.wikimedia.org/enwiki/latest/enwiki-latest-pages-articles-multistream-index.txt.bz2'
 
+# index ingest, _bulk request size and how many are in flight at once
+WIKI_BULK_BYTES = int(os.getenv('WIKI_BULK_BYTES', 5 * 1024 * 1024))
+WIKI_BULK_WORKERS = int(os.getenv('WIKI_BULK_WORKERS', 4))
+INDEX_CHECKPOINT = WIKI_DIR + 'index_checkpoint.json'
+
+# redirect source -> final target page id, built from the dump during ingest
+REDIRECT_DB = WIKI_DIR + 'redirects.db'
+
+# the index behind the wikipedia alias, bump when the mapping changes and the next sync migrates to it
+WIKI_INDEX = 'wikipedia_v4'
+
+# page id, title and stream of every article in a memory mapped table, and titles sorted at a time while building it
+TITLE_INDEX = WIKI_DIR + 'titles.idx'
+TITLE_SORT_CHUNK = int(os.getenv('TITLE_SORT_CHUNK', 1000000))
+
+# /wiki/suggest, titles returned by default and at most, and how long an answer is reused for a prefix
+SUGGEST_SIZE = int(os.getenv('SUGGEST_SIZE', 8))
+SUGGEST_MAX = int(os.getenv('SUGGEST_MAX', 20))
+SUGGEST_CACHE_TTL = float(os.getenv('SUGGEST_CACHE_TTL', 60))
+SUGGEST_CACHE_BYTES = int(os.getenv('SUGGEST_CACHE_BYTES', 8 * 1024 * 1024))
+SUGGEST_TIMEOUT = float(os.getenv('SUGGEST_TIMEOUT', 2))
+
+# articles already exported to Open WebUI, checked against the knowledge base every WIKI_RECONCILE_EVERY articles
+WIKI_MANIFEST = WIKI_DIR + 'manifest.db'
+WIKI_RECONCILE_EVERY = int(os.getenv('WIKI_RECONCILE_EVERY', 10000))
+
+# export pipeline, render processes, upload threads, and how many tasks each stage may queue beyond its workers
+WIKI_RENDER_WORKERS = int(os.getenv('WIKI_RENDER_WORKERS', os.cpu_count() or 1))
+WIKI_UPLOAD_WORKERS = int(os.getenv('WIKI_UPLOAD_WORKERS', 4))
+WIKI_QUEUE_SIZE = int(os.getenv('WIKI_QUEUE_SIZE', 16))
+
+# memory budget for decompressed dump streams kept around between article reads
+BLOCK_CACHE_BYTES = int(os.getenv('BLOCK_CACHE_BYTES', 256 * 1024 * 1024))
+
+# rendered articles for /view, memory in front of gzipped files on disk
+RENDER_CACHE_BYTES = int(os.getenv('RENDER_CACHE_BYTES', 64 * 1024 * 1024))
+RENDER_CACHE_DIR = WIKI_DIR + 'rendered/'
+
+# directory sync, uploads in flight at once and files per batch attach call
+UPLOAD_CONCURRENCY = int(os.getenv('UPLOAD_CONCURRENCY', 8))
+KNOWLEDGE_BATCH_SIZE = int(os.getenv('KNOWLEDGE_BATCH_SIZE', 100))
+
+# size, mtime and hash of every synced file so a sync only sends what changed
+SYNC_STATE = '/app/data/sync_state.db'
+
+# live sync of BASE_DIRECTORY, seconds a file must be quiet before it is pushed and the polling interval without inotify
+WATCH_FILES = os.getenv('WATCH_FILES', 'false').lower() == 'true'
+WATCH_DEBOUNCE = float(os.getenv('WATCH_DEBOUNCE', 2))
+WATCH_INTERVAL = float(os.getenv('WATCH_INTERVAL', 30))
+
+# directory walks, threads listing directories at once, and comma separated globs of files to sync or leave out
+WALK_WORKERS = int(os.getenv('WALK_WORKERS', 8))
+SYNC_INCLUDE = [pattern.strip() for pattern in os.getenv('SYNC_INCLUDE', '').split(',') if pattern.strip()]
+SYNC_EXCLUDE = [pattern.strip() for pattern in os.getenv('SYNC_EXCLUDE', '').split(',') if pattern.strip()]
+
+# directory listings, entries per page by default and at most, and memory for listings kept between requests
+LIST_PAGE_SIZE = int(os.getenv('LIST_PAGE_SIZE', 500))
+LIST_PAGE_MAX = int(os.getenv('LIST_PAGE_MAX', 5000))
+LIST_CACHE_BYTES = int(os.getenv('LIST_CACHE_BYTES', 32 * 1024 * 1024))
+
+# seconds browsers may reuse a downloaded document before checking its ETag again
+FILE_MAX_AGE = int(os.getenv('FILE_MAX_AGE', 0))
+
+# http to opensearch and open webui, pooled connections per host, timeouts in seconds, retries for idempotent calls,
+# backoff between them, and whether _bulk bodies are sent gzipped
+HTTP_POOL_SIZE = int(os.getenv('HTTP_POOL_SIZE', 16))
+HTTP_CONNECT_TIMEOUT = float(os.getenv('HTTP_CONNECT_TIMEOUT', 5))
+HTTP_READ_TIMEOUT = float(os.getenv('HTTP_READ_TIMEOUT', 120))
+HTTP_RETRIES = int(os.getenv('HTTP_RETRIES', 4))
+HTTP_BACKOFF = float(os.getenv('HTTP_BACKOFF', 0.5))
+HTTP_BACKOFF_MAX = float(os.getenv('HTTP_BACKOFF_MAX', 30))
+BULK_GZIP = os.getenv('BULK_GZIP', 'false').lower() == 'true'
+
+# seconds before the open webui token runs out that it is replaced
+AUTH_REFRESH_AHEAD = int(os.getenv('AUTH_REFRESH_AHEAD', 300))
+
+# background jobs, how many run at once, how many finished ones are kept, and errors kept per job
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', 2))
+JOB_HISTORY = int(os.getenv('JOB_HISTORY', 100))
+JOB_ERRORS = int(os.getenv('JOB_ERRORS', 20))
+
 BASE_URL = os.getenv('OPENWEBUI_URL', 'http://open-webui:8080') + '/api/v1/'
 
 DB_URL = os.getenv('OPENSEARCH_URI', 'http://opensearch-node1:9200')
\ No newline at end of file
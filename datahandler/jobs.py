@@ -0,0 +1,185 @@
+import sys
+import threading
+import time
+import traceback
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from flask import jsonify
+
+from config import *
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class Job:
+    """
+    Progress and cancellation for one long running sync.
+    The work function gets the job and reports through progress() and error(), and calls check() often enough to be cancelled.
+    """
+
+    def __init__(self, key, name):
+        self.id = uuid.uuid4().hex
+        self.key = key
+        self.name = name
+        self.status = 'queued'
+        self.stage = None
+        self.done = 0
+        self.total = None
+        self.error_count = 0
+        self.errors = []
+        self.result = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.cancelled = threading.Event()
+        self.lock = threading.Lock()
+
+    def progress(self, advance=0, done=None, total=None, stage=None):
+        with self.lock:
+            if stage is not None and stage != self.stage:
+                # new stage, new counters
+                self.stage = stage
+                self.done = 0
+                self.total = None
+                self.started = time.time()
+            if done is not None:
+                self.done = done
+            self.done += advance
+            if total is not None:
+                self.total = total
+
+    def error(self, message):
+        print(message, file=sys.stderr)
+        with self.lock:
+            self.error_count += 1
+            # keep the latest few
+            self.errors = (self.errors + [str(message)])[-JOB_ERRORS:]
+
+    def check(self):
+        if self.cancelled.is_set():
+            raise JobCancelled()
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def active(self):
+        return self.status in ('queued', 'running')
+
+    def to_dict(self):
+        with self.lock:
+            now = self.finished or time.time()
+            elapsed = now - self.started if self.started else 0
+            throughput = self.done / elapsed if elapsed > 0 else None
+            eta = None
+            if throughput and self.total is not None and self.status == 'running':
+                eta = max(0, self.total - self.done) / throughput
+            return {
+                'id': self.id,
+                'name': self.name,
+                'status': self.status,
+                'stage': self.stage,
+                'done': self.done,
+                'total': self.total,
+                'throughput': throughput,
+                'eta_seconds': eta,
+                'error_count': self.error_count,
+                'errors': self.errors,
+                'result': self.result,
+                'created': self.created,
+                'finished': self.finished
+            }
+
+
+class JobQueue:
+    """Runs jobs on a bounded pool, a job with the same key as one that hasn't finished yet isn't started twice."""
+
+    def __init__(self, workers):
+        self.pool = ThreadPoolExecutor(workers)
+        self.jobs = OrderedDict()
+        self.lock = threading.Lock()
+
+    def submit(self, key, name, fn, *args, **kwargs):
+        with self.lock:
+            for job in self.jobs.values():
+                if job.key == key and job.active():
+                    return job
+            job = Job(key, name)
+            self.jobs[job.id] = job
+            # forget the oldest finished jobs
+            finished = [id for id, old in self.jobs.items() if not old.active()]
+            for id in finished[:max(0, len(finished) - JOB_HISTORY)]:
+                del self.jobs[id]
+        self.pool.submit(self.run, job, fn, args, kwargs)
+        return job
+
+    def run(self, job, fn, args, kwargs):
+        if job.cancelled.is_set():
+            job.status = 'cancelled'
+            job.finished = time.time()
+            return
+        job.status = 'running'
+        job.started = time.time()
+        try:
+            job.result = fn(*args, job=job, **kwargs)
+            job.status = 'finished'
+        except JobCancelled:
+            job.status = 'cancelled'
+        except Exception as err:
+            traceback.print_exc()
+            job.error(err)
+            job.status = 'failed'
+        job.finished = time.time()
+
+    def get(self, id):
+        with self.lock:
+            return self.jobs.get(id)
+
+    def list(self):
+        with self.lock:
+            return list(self.jobs.values())
+
+
+queue = JobQueue(JOB_WORKERS)
+
+def run_exclusive(lock, job, fn, *args, **kwargs):
+    """
+    Run fn under lock, for builds that write the same files whichever job starts them.
+    If another job is already running it, wait for that one to finish instead of doing the same work again.
+    """
+    if lock.acquire(blocking=False):
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            lock.release()
+    job.progress(stage='waiting')
+    while not lock.acquire(timeout=1):
+        job.check()
+    lock.release()
+    return None
+
+def submit_job(key, name, fn, *args, **kwargs):
+    """Run fn(*args, job=job, **kwargs) in the background and return the job, or the one already doing this."""
+    return queue.submit(key, name, fn, *args, **kwargs)
+
+def job_routes(app):
+    @app.route('/jobs', methods=['GET'])
+    def list_jobs():
+        return jsonify([job.to_dict() for job in queue.list()])
+
+    @app.route('/jobs/<string:id>', methods=['GET'])
+    def get_job(id):
+        job = queue.get(id)
+        if job is None:
+            return jsonify({"error": "Job not found"}), 404
+        return jsonify(job.to_dict())
+
+    @app.route('/jobs/<string:id>/cancel', methods=['GET', 'POST'])
+    def cancel_job(id):
+        job = queue.get(id)
+        if job is None:
+            return jsonify({"error": "Job not found"}), 404
+        job.cancel()
+        return jsonify(job.to_dict())
@@ -1,11 +1,19 @@
 import os
 import sys
-import requests
-from flask import jsonify, send_file
+import json
+import client
+import hashlib
+from bisect import bisect_left, bisect_right
+from concurrent.futures import ThreadPoolExecutor
+from flask import jsonify, send_file, request
 from urllib.parse import unquote as URLDecoder
 from flask import redirect
 
 from auth import *
+from manifest import SyncState
+from jobs import Job, submit_job
+from walker import walk, walk_files, matches
+from cache import LRUCache
 
 from config import *
 
@@ -21,18 +29,48 @@ def knowledge_routes(app):
     @app.route('/get/<path:path>', methods=['GET'])
     def get_file_content(path):
         try:
-            path = URLDecoder(path)
-            return send_file(BASE_DIRECTORY + path)
-        except FileNotFoundError:
+            path = BASE_DIRECTORY + URLDecoder(path)
+            stat = os.stat(path)
+            # conditional lets werkzeug answer If-None-Match / If-Modified-Since with a 304 and Range with a 206
+            return send_file(
+                path,
+                conditional=True,
+                etag='%x-%x-%x' % (stat.st_ino, stat.st_size, stat.st_mtime_ns),
+                last_modified=stat.st_mtime,
+                max_age=FILE_MAX_AGE
+            )
+        except (FileNotFoundError, IsADirectoryError):
             return jsonify({"error": "File not found"}), 404
 
     @app.route('/list_files/<path:path>', methods=['GET'])
     def list_files_dynamic(path):
-        return list_files(path)
+        return list_files_route(path)
 
     @app.route('/list_files', methods=['GET'])
     def list_files_root():
-        return list_files('')
+        return list_files_route('')
+
+    def list_files_route(path):
+        sort = request.args.get('sort', 'name')
+        if sort not in ('name', 'size', 'mtime'):
+            return jsonify({"error": "sort must be name, size or mtime"}), 400
+        try:
+            limit = int(request.args.get('limit', LIST_PAGE_SIZE))
+            # cursor from the last page
+            after = request.args.get('after')
+            after = json.loads(after) if after else None
+        except ValueError:
+            return jsonify({"error": "limit must be a number and after a cursor from a previous page"}), 400
+        if after is not None and not valid_cursor(after, sort):
+            return jsonify({"error": "after is not a cursor for this sort"}), 400
+        return list_files(
+            path,
+            sort=sort,
+            reverse=request.args.get('order', 'asc') == 'desc',
+            limit=max(1, min(limit, LIST_PAGE_MAX)),
+            after=after,
+            meta=request.args.get('meta', 'false').lower() == 'true'
+        )
 
     @app.route('/list_knowledge', methods=['GET'])
     def list_knowledge_dynamic():
@@ -48,7 +86,7 @@ def knowledge_routes(app):
         url = BASE_URL + 'knowledge/' + id
 
         try:
-            response = requests.get(url, headers=auth_header())
+            response = client.get(url, headers=auth_header())
             return response.json()
         except Exception as err:
             print(err, file=sys.stderr)
@@ -56,32 +94,23 @@ def knowledge_routes(app):
         
     @app.route('/sync/', methods=['GET'])
     def sync_root():
-        files = []
-        directories = [BASE_DIRECTORY]
-
-        while directories:
-            current_directory = directories.pop()
-            for entry in os.listdir(current_directory):
-                full_path = os.path.join(current_directory, entry)
-                if os.path.isdir(full_path):
-                    directories.append(full_path)
-                else:
-                    files.append(full_path)
-        print(files, file=sys.stderr)
-        knowledgeid = sync('Default', files)
-        return redirect('/knowledge/' + knowledgeid)
+        # runs in the background, follow the redirect for progress
+        job = submit_job('sync:' + BASE_DIRECTORY, 'Sync ' + BASE_DIRECTORY, sync_tree, BASE_DIRECTORY)
+        return redirect('/jobs/' + job.id)
 
     @app.route('/sync/dir/<path:path>', methods=['GET'])
     def sync_dir(path):
-        files = []
-        for file in os.listdir(BASE_DIRECTORY + path):
-            if os.path.isdir(os.path.join(BASE_DIRECTORY + path, file)):
-                continue
-            files.append(os.path.join(BASE_DIRECTORY + path, file))
-        knowledgeid = sync(path.split('/')[-1], files)
-        return redirect('/knowledge/' + knowledgeid)
-
-def sync(name, files):
+        job = submit_job('sync_dir:' + path, 'Sync ' + BASE_DIRECTORY + path, sync_directory, BASE_DIRECTORY + path)
+        return redirect('/jobs/' + job.id)
+
+def sync_tree(root, job=None):
+    """Sync every file below root to the Default knowledge base, files are streamed from the walk as they are found."""
+    # filled in as the walk goes, complete by the time the files have all been read
+    failed = set()
+    files = walk_files(root, include=SYNC_INCLUDE, exclude=SYNC_EXCLUDE, onerror=lambda path, err: failed.add(path))
+    return sync('Default', files, root, job=job, failed=failed)
+
+def sync(name, files, root=None, recursive=True, create=True, job=None, failed=None):
     id = None
     knowledge_list = list_knowledge()
     if knowledge_list is None:
@@ -90,35 +119,168 @@ def sync(name, files):
     for knowledge in knowledge_list:
         if knowledge['name'] == name:
             id = knowledge['id']
-            add_files_to_knowledge(id, files)
+            add_files_to_knowledge(id, files, root, recursive, job, failed)
             return id
 
+    if not create:
+        return None
+
     if id is None:
         knowledge = create_knowledge(name, '')
         id = knowledge['id']
 
-    add_files_to_knowledge(id, files)
+    add_files_to_knowledge(id, files, root, recursive, job, failed)
     return id
 
-def list_files(path):
+def sync_directory(directory, create=True, job=None):
+    """
+    Sync the files directly inside directory to the knowledge base named after it, the base directory maps to Default.
+    With create off, directories that don't have a knowledge base yet are left alone.
+    """
+    files = directory_files(directory)
+    name = directory.rstrip('/').split('/')[-1]
+    if os.path.join(directory, '') == os.path.join(BASE_DIRECTORY, ''):
+        name = 'Default'
+    return sync(name, files, os.path.join(directory, ''), recursive=False, create=create, job=job)
+
+def directory_files(directory, base=None):
+    """
+    The files directly inside directory that a sync would send, none if it's gone.
+    The globs match paths from directory, or from base when given, so a directory sync_tree walked into
+    gets exactly the files sync_tree would have picked in it.
+    """
+    if not os.path.isdir(directory):
+        return []
+    relative = ''
+    if base is not None:
+        relative = os.path.join(directory, '')[len(os.path.join(base, '')):]
+    return list(walk_files(directory, include=SYNC_INCLUDE, exclude=SYNC_EXCLUDE, max_depth=0, relative=relative))
+
+def in_tree(directory):
+    """Whether sync_tree would have walked into directory, it has to be below BASE_DIRECTORY and not excluded."""
+    base = os.path.join(BASE_DIRECTORY, '')
+    directory = os.path.join(directory, '')
+    if not directory.startswith(base):
+        return False
+    relative = ''
+    for name in directory[len(base):].split('/')[:-1]:
+        relative += name
+        if SYNC_EXCLUDE and matches(relative, name, SYNC_EXCLUDE):
+            return False
+        relative += '/'
+    return True
+
+def sync_changes(directory, job=None):
+    """
+    Push the files directly inside directory to every knowledge base that holds them: Default, which sync_tree
+    fills with the whole of BASE_DIRECTORY, and the directory's own knowledge base if /sync/dir made one.
+    No knowledge base is created.
+    """
+    root = os.path.join(directory, '')
+    if in_tree(directory):
+        # chosen the way sync_tree chooses them, globs matched from BASE_DIRECTORY
+        sync('Default', directory_files(directory, BASE_DIRECTORY), root, recursive=False, create=False, job=job)
+    if root != os.path.join(BASE_DIRECTORY, ''):
+        # and the way /sync/dir does for the directory's own
+        name = directory.rstrip('/').split('/')[-1]
+        sync(name, directory_files(directory), root, recursive=False, create=False, job=job)
+
+def listing_size(listing):
+    _, entries, _ = listing
+    return sys.getsizeof(entries) + sum(sys.getsizeof(entry[0]) + 200 for entry in entries)
+
+listing_cache = LRUCache(LIST_CACHE_BYTES, sizeof=listing_size)
+
+def listing_key(entry, sort, reverse):
+    """Directories first either way, then the sort field, then the name to break ties."""
+    name, is_dir, size, mtime = entry
+    value = {'name': name, 'size': size or 0, 'mtime': mtime or 0}[sort]
+    return [int(is_dir == reverse), value, name]
+
+def valid_cursor(after, sort):
+    """Whether after has the shape listing_key gives for this sort, anything else can't be compared with the keys."""
+    if not isinstance(after, list) or len(after) != 3:
+        return False
+    is_dir, value, name = after
+    if sort == 'name':
+        value_ok = isinstance(value, str)
+    else:
+        value_ok = isinstance(value, (int, float)) and not isinstance(value, bool)
+    return is_dir in (0, 1) and not isinstance(is_dir, bool) and value_ok and isinstance(name, str)
+
+def get_listing(directory, sort, reverse, meta):
+    """
+    The entries of a directory as (name, is_dir, size, mtime), sorted ascending, and their sort keys.
+    Kept in listing_cache until the directory's mtime moves, which happens when entries are added, removed or renamed.
+    Writing to a file doesn't move it, so sizes and mtimes (and the order when sorting on them) can be stale
+    until something in the directory is added, removed or renamed.
+    """
+    # only stat the entries if something needs it
+    stat = meta or sort != 'name'
+    mtime = os.stat(directory).st_mtime_ns
+    key = (directory, sort, reverse, stat)
+    listing = listing_cache.get(key)
+    if listing is not None and listing[0] == mtime:
+        return listing
+
+    entries = []
+    for entry in walk(directory, max_depth=0, dirs=True, stat=stat):
+        is_dir = entry.is_dir()
+        size = None
+        modified = None
+        if stat:
+            info = entry.stat()
+            size = None if is_dir else info.st_size
+            modified = info.st_mtime
+        entries.append((entry.name, is_dir, size, modified))
+    keys = [listing_key(entry, sort, reverse) for entry in entries]
+    order = sorted(range(len(entries)), key=keys.__getitem__)
+    listing = (mtime, [entries[i] for i in order], [keys[i] for i in order])
+    listing_cache.put(key, listing)
+    return listing
+
+def list_files(path, sort='name', reverse=False, limit=LIST_PAGE_SIZE, after=None, meta=False):
+    """
+    One page of a directory, directories first.
+    Pass the returned after back in to get the next page, it is the sort key of the last entry,
+    so pages stay consistent while the directory changes underneath.
+    With meta or a size or mtime sort the listing comes from the cache, see get_listing for how stale it can be.
+    """
     directory = BASE_DIRECTORY + path
     try:
-        files = []
-        dirs = []
-        for file in os.listdir(directory):
-            if os.path.isdir(os.path.join(directory, file)):
-                dirs.append(file)
-            else:
-                files.append(file)
-        return jsonify({"files": files, "dirs": dirs}), 200
-    except FileNotFoundError:
+        _, entries, keys = get_listing(directory, sort, reverse, meta)
+    except (FileNotFoundError, NotADirectoryError):
         return jsonify({"error": "Directory not found"}), 404
+
+    if not reverse:
+        start = bisect_right(keys, after) if after is not None else 0
+        page = entries[start:start + limit]
+        more = start + limit < len(entries)
+    else:
+        # walk the ascending listing backwards, directories still come first as their key sorts last
+        end = bisect_left(keys, after) if after is not None else len(keys)
+        page = entries[max(0, end - limit):end][::-1]
+        more = end - limit > 0
+
+    files = []
+    dirs = []
+    for name, is_dir, _, _ in page:
+        (dirs if is_dir else files).append(name)
+    result = {
+        "files": files,
+        "dirs": dirs,
+        "total": len(entries),
+        "after": json.dumps(listing_key(page[-1], sort, reverse)) if page and more else None
+    }
+    if meta:
+        result["entries"] = [{"name": name, "dir": is_dir, "size": size, "mtime": mtime} for name, is_dir, size, mtime in page]
+    return jsonify(result), 200
     
 def list_knowledge():
     url = BASE_URL + 'knowledge/list'
 
     try:
-        response = requests.get(url, headers=auth_header())
+        response = client.get(url, headers=auth_header())
         return response.json()
     except Exception as err:
         print(err, file=sys.stderr)
@@ -133,7 +295,7 @@ def create_knowledge(name, description):
         }
     
     try:
-        response = requests.post(url, headers=auth_header(), json=data)
+        response = client.post(url, headers=auth_header(), json=data)
         return response.json()
     except Exception as err:
         print(err, file=sys.stderr)
@@ -143,18 +305,21 @@ def get_all_files():
     url = BASE_URL + 'files/'
 
     try:
-        response = requests.get(url, headers=auth_header())
+        response = client.get(url, headers=auth_header())
         return response.json()
     except Exception as err:
         print(err, file=sys.stderr)
         return None
     
-def upload_file(file, fileList=None, rename=None):
-    from app import current_token
+def upload_file(file, fileList=None, rename=None, content=None):
+    """
+    Upload a file to Open WebUI, or return the existing file with the same name.
+    file is a path on disk, or just the file name when content (bytes, str or a file object) is passed in.
+    """
     url = BASE_URL + 'files/'
     headers = {
         'accept': 'application/json',
-        'Authorization': 'Bearer ' + current_token
+        'Authorization': bearer()
     }
     name = file.split('/')[-1]
     if rename is not None:
@@ -165,9 +330,6 @@ def upload_file(file, fileList=None, rename=None):
         'description': ''
     }
     
-    files = { 
-        'file': (file, open(file, 'rb')),
-    }
     fileD = None
     # check if file exists
     try:
@@ -186,27 +348,179 @@ def upload_file(file, fileList=None, rename=None):
         return fileD
     else: # create file 
         try:
-            response = requests.post(url, headers=headers, files=files)
+            if content is not None:
+                # straight from memory, no temp file
+                if isinstance(content, str):
+                    content = content.encode('utf-8')
+                response = client.post(url, headers=headers, files={'file': (name, content)})
+            else:
+                with open(file, 'rb') as f:
+                    response = client.post(url, headers=headers, files={'file': (file, f)})
             return response.json()
         except Exception as err:
             print(err, file=sys.stderr)
             return None
         
-def add_files_to_knowledge(knowledge_id, files):
-    url = BASE_URL + 'knowledge/' + knowledge_id + '/file/add'
-
-    for file in files:
-        res = upload_file(file, get_all_files())
-        if res is not None:
-            if res.get('id') is not None:
-                data = { 
-                    'file_id': res['id']
-                }
-                try:
-                    response = requests.post(url, headers=auth_header(), json=data)
-                except Exception as err:
-                    print(err, file=sys.stderr)
-                    return None
+def attach_files(knowledge_id, file_ids):
+    """Attach files to a knowledge base KNOWLEDGE_BATCH_SIZE at a time, returns the ids that were attached."""
+    url = BASE_URL + 'knowledge/' + knowledge_id + '/files/batch/add'
+
+    attached = []
+    for i in range(0, len(file_ids), KNOWLEDGE_BATCH_SIZE):
+        batch = file_ids[i:i + KNOWLEDGE_BATCH_SIZE]
+        data = [{'file_id': file_id} for file_id in batch]
+        try:
+            # attaching a file that is already attached changes nothing
+            response = client.post(url, headers=auth_header(), json=data, idempotent=True)
+            if response.status_code == 200:
+                attached.extend(batch)
             else:
-                print('Failed to upload, response: ' + str(res), file=sys.stderr)
-    return requests.get(BASE_URL + 'knowledge/' + knowledge_id, headers=auth_header()).json()
\ No newline at end of file
+                print('Failed to attach files, response: ' + str(response.text), file=sys.stderr)
+        except Exception as err:
+            print(err, file=sys.stderr)
+    return attached
+
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def update_file(knowledge_id, file_id, path):
+    """
+    Swap the content of an uploaded file and have the knowledge base re-index it.
+    Open WebUI can only take new content as text, so this returns False for anything that isn't.
+    """
+    try:
+        with open(path, 'rb') as f:
+            content = f.read().decode('utf-8')
+    except UnicodeDecodeError:
+        return False
+
+    try:
+        response = client.post(BASE_URL + 'files/' + file_id + '/data/content/update', headers=auth_header(), json={'content': content}, idempotent=True)
+        if response.status_code != 200:
+            return False
+        response = client.post(BASE_URL + 'knowledge/' + knowledge_id + '/file/update', headers=auth_header(), json={'file_id': file_id}, idempotent=True)
+        return response.status_code == 200
+    except Exception as err:
+        print(err, file=sys.stderr)
+        return False
+
+def remove_file(knowledge_id, file_id):
+    """Take a file out of the knowledge base and delete it from Open WebUI."""
+    try:
+        client.post(BASE_URL + 'knowledge/' + knowledge_id + '/file/remove', headers=auth_header(), json={'file_id': file_id}, idempotent=True)
+        client.delete(BASE_URL + 'files/' + file_id, headers=auth_header())
+    except Exception as err:
+        print(err, file=sys.stderr)
+
+def add_files_to_knowledge(knowledge_id, files, root=None, recursive=True, job=None, failed=None):
+    """
+    Bring a knowledge base in line with files on disk.
+    Only new and changed files are sent, files are told apart by full path, and with root set
+    anything previously synced from under root (or directly in it, if not recursive) that is gone is removed as well.
+    failed holds directories the walk couldn't list, nothing under them is removed since we don't know what is there.
+    """
+    job = job or Job(None, 'add_files_to_knowledge')
+    state = SyncState(SYNC_STATE)
+    # files may be a list or a stream straight from the walk
+    job.progress(stage='scan', total=len(files) if hasattr(files, '__len__') else None)
+    new = []
+    changed = []
+    seen = set()
+    unchanged = 0
+    for path in files:
+        job.check()
+        job.progress(1)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            continue
+        seen.add(path)
+
+        entry = state.get(path, knowledge_id)
+        if entry is not None and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime_ns:
+            unchanged += 1
+            continue
+        hash = file_hash(path)
+        if entry is not None and entry['hash'] == hash:
+            # touched but not changed
+            state.put(path, knowledge_id, stat.st_size, stat.st_mtime_ns, hash, entry['file_id'])
+            unchanged += 1
+            continue
+        if entry is None:
+            new.append((path, stat, hash))
+        else:
+            changed.append((path, stat, hash, entry['file_id']))
+
+    removed = []
+    if root is not None:
+        unlisted = tuple(os.path.join(path, '') for path in (failed or ()))
+        removed = [entry for entry in state.under(knowledge_id, root, recursive)
+                   if entry['path'] not in seen and not entry['path'].startswith(unlisted)]
+
+    if not (new or changed or removed):
+        return {'added': 0, 'updated': 0, 'removed': 0, 'unchanged': unchanged}
+
+    # one snapshot of the knowledge base for the whole sync
+    knowledge = client.get(BASE_URL + 'knowledge/' + knowledge_id, headers=auth_header()).json()
+    existing = {}
+    for f in knowledge.get('files', []):
+        meta = f.get('meta', {})
+        existing.setdefault((f.get('filename') or meta.get('name'), meta.get('size')), f['id'])
+
+    # every file counts once, a changed file that goes up again as a new one counts when it's uploaded
+    job.progress(stage='push', total=len(removed) + len(changed) + len(new))
+    # removed from the knowledge base since the snapshot was taken, never to be matched as already there
+    dropped = set()
+    for entry in removed:
+        job.check()
+        remove_file(knowledge_id, entry['file_id'])
+        dropped.add(entry['file_id'])
+        state.remove(entry['path'], knowledge_id)
+        job.progress(1)
+
+    # text files are updated in place, anything else goes up again as a new file
+    updated = 0
+    for path, stat, hash, file_id in changed:
+        job.check()
+        if update_file(knowledge_id, file_id, path):
+            state.put(path, knowledge_id, stat.st_size, stat.st_mtime_ns, hash, file_id)
+            updated += 1
+            job.progress(1)
+        else:
+            remove_file(knowledge_id, file_id)
+            state.remove(path, knowledge_id)
+            dropped.add(file_id)
+            new.append((path, stat, hash))
+
+    def upload(item):
+        path, stat, hash = item
+        job.check()
+        try:
+            # a file uploaded before we kept sync state, same name and size is already in the knowledge base
+            file_id = existing.get((os.path.basename(path), stat.st_size))
+            if file_id is not None and file_id not in dropped:
+                return file_id, False
+            # empty file list so same-named files from different directories both get uploaded
+            res = upload_file(path, [])
+            if res is None or res.get('id') is None:
+                job.error('Failed to upload ' + path + ', response: ' + str(res))
+                return None, False
+            return res['id'], True
+        finally:
+            job.progress(1)
+
+    with ThreadPoolExecutor(UPLOAD_CONCURRENCY) as pool:
+        results = list(pool.map(upload, new))
+
+    attached = set(attach_files(knowledge_id, [file_id for file_id, fresh in results if fresh]))
+    added = 0
+    for (path, stat, hash), (file_id, fresh) in zip(new, results):
+        if file_id is not None and (not fresh or file_id in attached):
+            state.put(path, knowledge_id, stat.st_size, stat.st_mtime_ns, hash, file_id)
+            added += 1
+
+    return {'added': added, 'updated': updated, 'removed': len(removed), 'unchanged': unchanged}
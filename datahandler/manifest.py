@@ -0,0 +1,141 @@
+import os
+import sqlite3
+import threading
+
+
+class Manifest:
+    """
+    Which wikipedia articles have already been exported to Open WebUI.
+    Kept in sqlite so the export can check an article in O(1) instead of asking Open WebUI every time.
+    An article is done for a knowledge base once knowledge_id is set, file_id is empty for articles we chose to skip.
+    """
+
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock:
+            self.conn.execute('PRAGMA journal_mode = WAL')
+            self.conn.execute('PRAGMA synchronous = NORMAL')
+            self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS articles (
+                    article_id INTEGER PRIMARY KEY,
+                    filename TEXT,
+                    hash TEXT,
+                    file_id TEXT,
+                    knowledge_id TEXT
+                )
+            ''')
+            self.conn.commit()
+
+    def get(self, article_id):
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT filename, hash, file_id, knowledge_id FROM articles WHERE article_id = ?', (int(article_id),)
+            ).fetchone()
+        if row is None:
+            return None
+        return {'filename': row[0], 'hash': row[1], 'file_id': row[2], 'knowledge_id': row[3]}
+
+    def done(self, article_id, knowledge_id):
+        entry = self.get(article_id)
+        return entry is not None and entry['knowledge_id'] == knowledge_id
+
+    def uploaded(self, article_id, filename, hash, file_id):
+        """Record an uploaded file that isn't attached to anything yet."""
+        with self.lock:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO articles VALUES (?, ?, ?, ?, NULL)', (int(article_id), filename, hash, file_id)
+            )
+            self.conn.commit()
+
+    def attached(self, article_id, knowledge_id):
+        with self.lock:
+            self.conn.execute('UPDATE articles SET knowledge_id = ? WHERE article_id = ?', (knowledge_id, int(article_id)))
+            self.conn.commit()
+
+    def skipped(self, article_id, filename, hash, knowledge_id):
+        """Record an article that isn't worth uploading (redirects, stubs) so it isn't rendered again."""
+        with self.lock:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO articles VALUES (?, ?, ?, NULL, ?)', (int(article_id), filename, hash, knowledge_id)
+            )
+            self.conn.commit()
+
+    def reconcile(self, knowledge_id, files):
+        """
+        Bring the manifest in line with the files Open WebUI actually has in the knowledge base.
+        Articles whose file has gone missing are marked not attached, so the next export puts them back.
+        """
+        with self.lock:
+            self.conn.execute('CREATE TEMP TABLE IF NOT EXISTS present (file_id TEXT PRIMARY KEY)')
+            self.conn.execute('DELETE FROM present')
+            self.conn.executemany('INSERT OR IGNORE INTO present VALUES (?)', [(file['id'],) for file in files])
+            self.conn.execute('''
+                UPDATE articles SET knowledge_id = NULL
+                WHERE knowledge_id = ? AND file_id IS NOT NULL AND file_id NOT IN (SELECT file_id FROM present)
+            ''', (knowledge_id,))
+            self.conn.execute('''
+                UPDATE articles SET knowledge_id = ?
+                WHERE knowledge_id IS NULL AND file_id IN (SELECT file_id FROM present)
+            ''', (knowledge_id,))
+            self.conn.commit()
+
+
+class SyncState:
+    """
+    What each file on disk looked like when it was last synced to a knowledge base.
+    Lets a sync skip anything whose size and mtime haven't moved without reading it.
+    """
+
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock:
+            self.conn.execute('PRAGMA journal_mode = WAL')
+            self.conn.execute('PRAGMA synchronous = NORMAL')
+            self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS files (
+                    path TEXT,
+                    knowledge_id TEXT,
+                    size INTEGER,
+                    mtime INTEGER,
+                    hash TEXT,
+                    file_id TEXT,
+                    PRIMARY KEY (path, knowledge_id)
+                )
+            ''')
+            self.conn.commit()
+
+    def get(self, path, knowledge_id):
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT size, mtime, hash, file_id FROM files WHERE path = ? AND knowledge_id = ?', (path, knowledge_id)
+            ).fetchone()
+        if row is None:
+            return None
+        return {'path': path, 'size': row[0], 'mtime': row[1], 'hash': row[2], 'file_id': row[3]}
+
+    def put(self, path, knowledge_id, size, mtime, hash, file_id):
+        with self.lock:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)', (path, knowledge_id, size, mtime, hash, file_id)
+            )
+            self.conn.commit()
+
+    def remove(self, path, knowledge_id):
+        with self.lock:
+            self.conn.execute('DELETE FROM files WHERE path = ? AND knowledge_id = ?', (path, knowledge_id))
+            self.conn.commit()
+
+    def under(self, knowledge_id, root, recursive=True):
+        """Every file recorded for this knowledge base below root, or directly in it when not recursive."""
+        # escape LIKE wildcards in the directory name
+        prefix = root.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT path, size, mtime, hash, file_id FROM files WHERE knowledge_id = ? AND path LIKE ? ESCAPE '\\'",
+                (knowledge_id, prefix + '%')
+            ).fetchall()
+        if not recursive:
+            rows = [row for row in rows if os.path.dirname(row[0]) == root.rstrip('/')]
+        return [{'path': row[0], 'size': row[1], 'mtime': row[2], 'hash': row[3], 'file_id': row[4]} for row in rows]
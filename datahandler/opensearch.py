@@ -1,12 +1,16 @@
-from config import DB_URL
+from config import DB_URL, BULK_GZIP, WIKI_INDEX
+import client
 import requests
 import sys
+import time
+
+from jobs import Job
 
 def get_opensearch(indexname = '_cluster/health'):
     url = DB_URL + '/' + indexname
 
     try:
-        response = requests.get(url)
+        response = client.get(url)
         if response.status_code == 200:
             print(f"OpenSearch response: {response.json()}", file=sys.stderr)  # Log the response for debugging
             return response.json()
@@ -17,26 +21,184 @@ def get_opensearch(indexname = '_cluster/health'):
         print(err, file=sys.stderr)
         return None
     
-def create_opensearch(indexname = 'wikipedia'):
+def create_opensearch(indexname = WIKI_INDEX, alias = 'wikipedia'):
+    """Create the articles index, everything else reads and writes it through alias so it can be rebuilt underneath."""
     url = DB_URL + '/' + indexname
     data = {
+        "settings": {
+            "analysis": {
+                "normalizer": {
+                    "title_normalizer": { # exact title lookups ignore case and stray whitespace
+                        "type": "custom",
+                        "filter": ["lowercase", "trim"]
+                    }
+                }
+            }
+        },
         "mappings": {
             "properties": {
                 "title": { # third the article title.
-                    "type": "text"
+                    "type": "text",
+                    "fields": {
+                        "keyword": {
+                            "type": "keyword",
+                            "normalizer": "title_normalizer",
+                            "ignore_above": 1024
+                        },
+                        "suggest": { # prefixes for /wiki/suggest, served from memory by the completion suggester
+                            "type": "completion",
+                            "analyzer": "simple"
+                        }
+                    }
+                },
+                "seek": { # first field of this index is the number of bytes to seek into the compressed archive, past 2^31 on enwiki
+                    "type": "long"
                 },
-                "seek": { # first field of this index is the number of bytes to seek into the compressed archive 
-                    "type": "integer"
+                "end": { # where the next stream starts, so the article's stream can be read in one go
+                    "type": "long"
+                },
+                "page_id": { # the _id again as a number, a tiebreaker for sorting that doesn't need _id fielddata
+                    "type": "long"
                 }
             }
         }
-    }                
-    
+    }
+    if alias is not None:
+        data["aliases"] = {alias: {}}
+
     try:
-        # requests.put('http://opensearch-node:9200/wikipedia')
-        response = requests.put(url, json=data)
+        response = client.put(url, json=data)
         return response.json()
     except Exception as err:
         print(err, file=sys.stderr)
         return None
 
+def delete_opensearch(name = 'wikipedia'):
+    """Delete the indices behind name, an index or an alias."""
+    indices = get_opensearch(name)
+    for index in (indices or {}):
+        print(client.delete(DB_URL + '/' + index).json(), file=sys.stderr)
+
+def migrate_opensearch(name = 'wikipedia', job = None):
+    """
+    Move an index made by an older create_opensearch onto WIKI_INDEX, copying the documents with _reindex
+    and trimming titles and filling in page_id on the way, then point name at it and drop the old index in one alias update.
+    Returns True if there was anything to migrate.
+    """
+    job = job or Job(None, 'migrate_opensearch')
+    indices = get_opensearch(name)
+    if indices is None or WIKI_INDEX in indices:
+        return False
+    old = next(iter(indices))
+    print('Migrating ' + old + ' to ' + WIKI_INDEX, file=sys.stderr)
+
+    if get_opensearch(WIKI_INDEX) is not None:
+        # left over from a migration that didn't finish
+        client.delete(DB_URL + '/' + WIKI_INDEX)
+    create_opensearch(WIKI_INDEX, alias=None)
+
+    response = client.post(DB_URL + '/_reindex', params={'wait_for_completion': 'false', 'slices': 'auto'}, json={
+        "source": {"index": old},
+        "dest": {"index": WIKI_INDEX, "op_type": "create"},
+        "conflicts": "proceed",
+        "script": {
+            "lang": "painless",
+            "source": "if (ctx._source.title != null) { ctx._source.title = ctx._source.title.trim() } ctx._source.page_id = Long.parseLong(ctx._id)"
+        }
+    })
+    if response.status_code != 200:
+        raise Exception('Failed to start reindex: ' + response.text)
+    task = response.json()['task']
+
+    job.progress(stage='migrate')
+    while True:
+        job.check()
+        status = client.get(DB_URL + '/_tasks/' + task).json()
+        progress = status.get('task', {}).get('status', {})
+        job.progress(done=progress.get('created', 0) + progress.get('version_conflicts', 0), total=progress.get('total'))
+        if status.get('completed'):
+            break
+        time.sleep(5)
+    failures = status.get('response', {}).get('failures') or status.get('error')
+    if failures:
+        raise Exception('Reindex into ' + WIKI_INDEX + ' failed: ' + str(failures)[:1000])
+
+    response = client.post(DB_URL + '/_aliases', json={
+        "actions": [
+            {"add": {"index": WIKI_INDEX, "alias": name}},
+            {"remove_index": {"index": old}}
+        ]
+    })
+    if response.status_code != 200:
+        raise Exception('Failed to switch ' + name + ' to ' + WIKI_INDEX + ': ' + response.text)
+    print('Migrated ' + old + ' to ' + WIKI_INDEX, file=sys.stderr)
+    return True
+
+def get_opensearch_settings(indexname = 'wikipedia'):
+    url = DB_URL + '/' + indexname + '/_settings'
+
+    try:
+        response = client.get(url)
+        # keyed by the concrete index name
+        return next(iter(response.json().values()))['settings']['index']
+    except Exception as err:
+        print(err, file=sys.stderr)
+        return None
+
+def update_opensearch_settings(settings, indexname = 'wikipedia'):
+    url = DB_URL + '/' + indexname + '/_settings'
+
+    try:
+        response = client.put(url, json={"index": settings})
+        return response.json()
+    except Exception as err:
+        print(err, file=sys.stderr)
+        return None
+
+def bulk(indexname, actions, retries = 8):
+    """
+    Send (action, document) pairs, each already serialized to a json line, to _bulk.
+    When OpenSearch pushes back with 429 the request (or just the rejected items) is retried with backoff,
+    so are 5xx responses and dropped connections.
+    Returns the number of items that failed for any other reason.
+    """
+    url = DB_URL + '/' + indexname + '/_bulk'
+    headers = {
+        'Content-Type': 'application/x-ndjson'
+    }
+    failed = 0
+    for attempt in range(retries + 1):
+        if attempt > 0:
+            time.sleep(client.backoff(attempt))
+
+        body = ''.join(action + '\n' + document + '\n' for action, document in actions)
+        # create and index are both safe to send again, with create anything already in gets a 409.
+        # no retries in the client, the 429 handling here already backs off and only resends what was rejected
+        try:
+            response = client.post(url, data=body.encode('utf-8'), headers=headers, compress=BULK_GZIP, idempotent=True, retries=0)
+        except (requests.ConnectionError, requests.Timeout) as err:
+            print('Retrying bulk upload after ' + str(err), file=sys.stderr)
+            continue
+        if response.status_code in client.RETRY_STATUS:
+            continue
+        if response.status_code != 200:
+            print(response.text, file=sys.stderr)
+            raise Exception('Failed to upload chunk: ' + str(response))
+
+        result = response.json()
+        if not result.get('errors'):
+            return failed
+
+        rejected = []
+        for pair, item in zip(actions, result['items']):
+            status = next(iter(item.values())).get('status', 200)
+            if status == 429:
+                rejected.append(pair)
+            elif status >= 300 and status != 409: # 409 is create on a document we already have
+                print(item, file=sys.stderr)
+                failed += 1
+        if not rejected:
+            return failed
+        actions = rejected
+
+    raise Exception('Gave up on bulk upload after ' + str(retries) + ' retries')
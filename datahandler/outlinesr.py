@@ -3,7 +3,7 @@ import json
 from outlines import models
 from outlines.models.openai import OpenAIConfig
 
-import requests
+import client
 from flask import request, jsonify
 import sys
 from urllib.parse import unquote as URLDecoder
@@ -177,7 +177,8 @@ def file_handler(file):
         
         with open(temp_path, 'rb') as f:
             pdf_data = f.read()
-        response = requests.put(url, data=pdf_data, headers=headers)
+        # a pdf tika can't read fails the same way twice, don't keep at it
+        response = client.put(url, data=pdf_data, headers=headers, retries=1)
         if response.status_code == 200:
             file_content = response.text
         else:
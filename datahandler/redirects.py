@@ -0,0 +1,114 @@
+import bz2
+import os
+import sqlite3
+import sys
+import threading
+import xml.etree.ElementTree as ET
+
+from jobs import Job, run_exclusive
+
+from config import *
+
+# one connection per thread, reopened if the table gets rebuilt underneath us
+# or we are a forked render worker that inherited the parent's
+local = threading.local()
+# sync_wiki and /sync_redirects both build into the same tmp file
+build_lock = threading.Lock()
+
+def connect():
+    key = (os.stat(REDIRECT_DB).st_ino, os.getpid())
+    if getattr(local, 'key', None) != key:
+        local.conn = sqlite3.connect(REDIRECT_DB)
+        local.key = key
+    return local.conn
+
+def resolve_redirect(page_id):
+    """Return the id of the article page_id finally redirects to, or None if it isn't a known redirect."""
+    try:
+        row = connect().execute('SELECT target FROM redirects WHERE source = ?', (int(page_id),)).fetchone()
+    except (OSError, sqlite3.Error):
+        # no table yet
+        return None
+    if row is None:
+        return None
+    return row[0]
+
+def iter_redirects(dump_filename):
+    """Yield (page_id, target title) for every redirect page in the dump."""
+    with bz2.open(dump_filename, 'rb') as f:
+        root = None
+        for event, elem in ET.iterparse(f, events=('start', 'end')):
+            if root is None:
+                root = elem
+            if event != 'end' or elem.tag.rpartition('}')[2] != 'page':
+                continue
+            redirect = elem.find('{*}redirect')
+            if redirect is not None:
+                yield int(elem.findtext('{*}id')), redirect.get('title')
+            root.clear()
+
+def build_redirects(dump_filename, index_filename, batch=10000, job=None):
+    """
+    Walk the whole dump once and record redirect source -> final target page id.
+    Targets are matched on exact title against the multistream index, and chains of redirects are collapsed.
+    The table is built next to the live one and swapped in when done.
+    If another job is building it already this waits for that one.
+    """
+    job = job or Job(None, 'build_redirects')
+    return run_exclusive(build_lock, job, write_redirects, dump_filename, index_filename, batch, job)
+
+def write_redirects(dump_filename, index_filename, batch, job):
+    tmp = REDIRECT_DB + '.tmp'
+    if os.path.exists(tmp):
+        os.remove(tmp)
+    conn = sqlite3.connect(tmp)
+    conn.execute('PRAGMA journal_mode = OFF')
+    conn.execute('PRAGMA synchronous = OFF')
+    conn.execute('CREATE TABLE titles (title TEXT PRIMARY KEY, id INTEGER) WITHOUT ROWID')
+    conn.execute('CREATE TABLE redirects (source INTEGER PRIMARY KEY, target_title TEXT, target INTEGER)')
+
+    print('Loading titles for redirects', file=sys.stderr)
+    with bz2.open(index_filename, 'rt') as f:
+        rows = []
+        for line in f:
+            l = line.rstrip('\n').split(':')
+            if len(l) < 3:
+                continue
+            rows.append((':'.join(l[2:]), int(l[1])))
+            if len(rows) >= batch:
+                conn.executemany('INSERT OR IGNORE INTO titles VALUES (?, ?)', rows)
+                rows = []
+        conn.executemany('INSERT OR IGNORE INTO titles VALUES (?, ?)', rows)
+
+    print('Collecting redirects', file=sys.stderr)
+    job.progress(stage='redirects')
+    rows = []
+    count = 0
+    for source, target_title in iter_redirects(dump_filename):
+        job.check()
+        # links to a section still land on the article
+        rows.append((source, target_title.split('#')[0].strip()))
+        if len(rows) >= batch:
+            conn.executemany('INSERT OR REPLACE INTO redirects (source, target_title) VALUES (?, ?)', rows)
+            count += len(rows)
+            job.progress(done=count)
+            print('Collected ' + str(count) + ' redirects', file=sys.stderr)
+            rows = []
+    conn.executemany('INSERT OR REPLACE INTO redirects (source, target_title) VALUES (?, ?)', rows)
+
+    conn.execute('UPDATE redirects SET target = (SELECT id FROM titles WHERE title = redirects.target_title)')
+    # follow double redirects, capped like the old recursive lookup
+    for _ in range(6):
+        changed = conn.execute('''
+            UPDATE redirects SET target = (SELECT r.target FROM redirects r WHERE r.source = redirects.target)
+            WHERE target IN (SELECT source FROM redirects WHERE target IS NOT NULL AND source != target)
+        ''').rowcount
+        if changed == 0:
+            break
+    conn.execute('DROP TABLE titles')
+    conn.commit()
+    conn.execute('VACUUM')
+    conn.close()
+
+    os.replace(tmp, REDIRECT_DB)
+    print('Finished building redirects', file=sys.stderr)
@@ -0,0 +1,32 @@
+import os
+
+import pytest
+
+import knowledge
+from walker import walk_files
+
+FILES = ['top.pdf', 'top.txt', 'pdfs/a.pdf', 'pdfs/b.pdf', 'pdfs/c.txt', 'docs/notes/x.txt', 'docs/notes/y.pdf']
+
+@pytest.fixture
+def base(tmp_path):
+    for name in FILES:
+        path = tmp_path / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(name)
+    return str(tmp_path) + '/'
+
+@pytest.mark.parametrize('include, exclude', [
+    ([], []),
+    (['pdfs/*.pdf'], []),
+    (['*.pdf'], []),
+    ([], ['pdfs/b.pdf']),
+    ([], ['docs/notes/*.txt']),
+    (['docs/*'], ['*.pdf']),
+])
+def test_watcher_picks_what_sync_tree_picks(base, monkeypatch, include, exclude):
+    monkeypatch.setattr(knowledge, 'SYNC_INCLUDE', include)
+    monkeypatch.setattr(knowledge, 'SYNC_EXCLUDE', exclude)
+    tree = set(walk_files(base, include=include, exclude=exclude))
+    for directory in [base, base + 'pdfs', base + 'docs', base + 'docs/notes']:
+        expected = sorted(path for path in tree if os.path.dirname(path) == directory.rstrip('/'))
+        assert sorted(knowledge.directory_files(directory, base)) == expected
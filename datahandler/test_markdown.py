@@ -0,0 +1,46 @@
+import glob
+import os
+import random
+
+import pytest
+
+from bench_wikitext import normalize_markdown, sample_article
+from wiki import format_wikitext, format_markdown, html_to_markdown
+
+SAMPLES = sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'samples', '*.wiki')))
+
+# bits of wikitext that html2text is fussy about, strung together at random
+FRAGMENTS = [
+    "text ", " ", "\n", "\n\n", "\t", "\xa0", "- ", "\n- item", "\n* star", "\n# num", "1. ", "\n1. x", "+ ", "\\", "\\-",
+    "'", "''", "'''", '"', "&", "&amp;", "&nbsp;", "<", ">", "<b>x</b>", "<nowiki>[[n]]</nowiki>", "<!-- c -->",
+    "{{t|a}}", "[[Link]]", "[[A|b c]]", " [[A| - b]]", "[[File:x.jpg|thumb|Cap [[In]] and In]]",
+    "[http://e.com ext]", "[http://e.com]", "\n== H ==\n", "\n=== - H3 ===\n", "==X==",
+    "<ref>{{cite web|url=https://a|title= - T |first=A|last=B|date=2020|website=W}}</ref>",
+    "<ref>{{cite book|title=T|date=2020}}</ref>", "<ref>plain - r</ref>", "<ref name=x/>", "<ref></ref>", "{|\n| a\n|}",
+]
+
+def two_step(wikitext):
+    return normalize_markdown(html_to_markdown(format_wikitext(wikitext), 'Title'))
+
+def one_pass(wikitext):
+    return normalize_markdown(format_markdown(wikitext, 'Title'))
+
+@pytest.mark.parametrize('path', SAMPLES, ids=os.path.basename)
+def test_samples_match_html2text(path):
+    with open(path, encoding='utf-8') as f:
+        wikitext = f.read()
+    assert one_pass(wikitext) == two_step(wikitext)
+
+@pytest.mark.parametrize('seed', range(3))
+def test_generated_articles_match_html2text(seed):
+    wikitext = sample_article(seed, sections=10)
+    assert one_pass(wikitext) == two_step(wikitext)
+
+def test_fragments_match_html2text():
+    rng = random.Random(0)
+    for _ in range(2000):
+        wikitext = ''.join(rng.choice(FRAGMENTS) for _ in range(rng.randint(0, 20)))
+        assert one_pass(wikitext) == two_step(wikitext), repr(wikitext)
+
+def test_empty_article():
+    assert one_pass('{{Infobox}}') == two_step('{{Infobox}}')
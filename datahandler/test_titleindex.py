@@ -0,0 +1,65 @@
+import bz2
+import random
+
+import pytest
+
+from titleindex import TitleIndex, build_title_index
+
+# ascii, multi-byte, shared 8 byte prefixes and colons in the title, as the multistream index has them
+NAMES = ['Albert', 'Alba', 'Albert Einstein', 'Über', 'Ünicode 東京', 'Category:Physics', 'A', 'Z']
+
+@pytest.fixture(scope='module')
+def index(tmp_path_factory):
+    directory = tmp_path_factory.mktemp('titles')
+    rng = random.Random(1)
+    ids = rng.sample(range(1, 10000000), 3000)
+    titles = set()
+    rows = []
+    seek = 600
+    for stream in range(30):
+        for _ in range(100):
+            title = rng.choice(NAMES)
+            while title in titles:
+                title = rng.choice(NAMES) + ' ' + ''.join(rng.choice('abcXYZ :') for _ in range(rng.randint(1, 12))).strip()
+            titles.add(title)
+            rows.append((seek, ids[len(rows)], title))
+        seek += rng.randint(1000, 100000)
+    with bz2.open(directory / 'index.txt.bz2', 'wt', encoding='utf-8') as f:
+        for row in rows:
+            f.write('%d:%d:%s\n' % row)
+    # a small chunk so the titles are merged from several runs
+    build_title_index(str(directory / 'index.txt.bz2'), seek, path=str(directory / 'titles.idx'), chunk=700)
+    index = TitleIndex(str(directory / 'titles.idx'))
+    yield index, rows, seek
+    index.close()
+
+def test_every_row_round_trips(index):
+    index, rows, dump_size = index
+    assert len(index) == len(rows)
+    seeks = sorted(set(seek for seek, _, _ in rows)) + [dump_size]
+    for seek, page_id, title in rows:
+        end = seeks[seeks.index(seek) + 1]
+        expected = {'_id': str(page_id), '_source': {'title': title, 'seek': seek, 'end': end}}
+        assert index.locate(page_id) == expected
+        assert index.find(title) == expected
+
+def test_missing(index):
+    index, rows, _ = index
+    known = set(page_id for _, page_id, _ in rows)
+    assert index.locate(next(i for i in range(1, 100) if i not in known)) is None
+    assert index.find('Not a title') is None
+
+def test_find_canonical(index):
+    index, rows, _ = index
+    seek, page_id, title = next(row for row in rows if ' ' in row[2] and row[2][0].isupper() and row[2][0].isascii())
+    assert index.find(title[0].lower() + title[1:].replace(' ', '_'))['_id'] == str(page_id)
+
+@pytest.mark.parametrize('prefix', ['Alb', 'Albert', 'Albert E', 'Ünicode 東', 'Category:Phys', 'Q'])
+def test_prefix(index, prefix):
+    index, rows, _ = index
+    expected = sorted((title.encode('utf-8'), page_id) for _, page_id, title in rows if title.startswith(prefix))[:10]
+    assert index.prefix(prefix, 10) == [(title.decode('utf-8'), page_id) for title, page_id in expected]
+
+def test_scan_in_dump_order(index):
+    index, rows, _ = index
+    assert [(hit['_source']['seek'], int(hit['_id']), hit['_source']['title']) for hit in index.scan(chunk=333)] == rows
@@ -0,0 +1,317 @@
+import bz2
+import heapq
+import mmap
+import os
+import shutil
+import struct
+import sys
+import tempfile
+import threading
+from array import array
+from bisect import bisect_left
+
+import numpy as np
+
+from jobs import Job, run_exclusive
+
+from config import *
+
+# The multistream index as one memory mapped file, so titles and page ids resolve without OpenSearch.
+#
+#     header
+#     rows      (id u32, stream u32, title offset u64) sorted by id
+#     streams   u64 seek of every stream, then the dump size as the end of the last one
+#     order     u32 row of every article in dump order
+#     titles    u32 row of every article sorted by title
+#     prefixes  u64 first 8 bytes of each title in the same order, big endian, so numpy can search them
+#     blob      u16 length + utf-8 title, per article
+
+MAGIC = b'WTIX'
+VERSION = 1
+HEADER = struct.Struct('<4sIQQQQQQQQ')  # magic, version, rows, streams, then where each section starts
+ROW = np.dtype([('id', '<u4'), ('stream', '<u4'), ('title', '<u8')])
+LENGTH = struct.Struct('<H')
+RUN = struct.Struct('<HI')  # title length, input row
+
+def prefix_key(title):
+    """The first 8 bytes of a title as a number that sorts the same way the bytes do."""
+    return int.from_bytes(title[:8].ljust(8, b'\0'), 'big')
+
+def search_key(title):
+    # as a numpy uint64, a plain int is compared against the column as a float and loses the low bits
+    return np.uint64(prefix_key(title))
+
+def canonical(title):
+    # how MediaWiki stores titles, spaces not underscores and a capital first letter
+    title = title.replace('_', ' ').strip()
+    return title[:1].upper() + title[1:]
+
+
+class Titles:
+    """Titles in sorted order as a sequence, for bisect."""
+
+    def __init__(self, index):
+        self.index = index
+
+    def __getitem__(self, i):
+        return self.index.title_bytes(int(self.index.titles[i]))
+
+
+class TitleIndex:
+    """Read side of the table, everything is looked up straight from the mapped file."""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, count, streams, rows, starts, order, titles, prefixes, blob = HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(path + ' is not a title index this version can read')
+        self.count = count
+        self.rows = np.frombuffer(self.mm, ROW, count, rows)
+        self.ids = self.rows['id']
+        self.streams = np.frombuffer(self.mm, '<u8', streams + 1, starts)
+        self.order = np.frombuffer(self.mm, '<u4', count, order)
+        self.titles = np.frombuffer(self.mm, '<u4', count, titles)
+        self.prefixes = np.frombuffer(self.mm, '<u8', count, prefixes)
+        self.blob = blob
+        self.sorted = Titles(self)
+
+    def __len__(self):
+        return self.count
+
+    def title_bytes(self, row):
+        offset = self.blob + int(self.rows['title'][row])
+        length = LENGTH.unpack_from(self.mm, offset)[0]
+        return self.mm[offset + 2:offset + 2 + length]
+
+    def hit(self, row):
+        """The row in the shape OpenSearch returns articles in."""
+        row = int(row)
+        stream = int(self.rows['stream'][row])
+        return {
+            '_id': str(int(self.ids[row])),
+            '_source': {
+                'title': self.title_bytes(row).decode('utf-8'),
+                'seek': int(self.streams[stream]),
+                'end': int(self.streams[stream + 1])
+            }
+        }
+
+    def find_id(self, page_id):
+        """Row of a page id, or None."""
+        i = int(np.searchsorted(self.ids, page_id))
+        if i < self.count and self.ids[i] == page_id:
+            return i
+        return None
+
+    def locate(self, page_id):
+        """The article with this page id, as an OpenSearch style hit, or None."""
+        row = self.find_id(int(page_id))
+        return None if row is None else self.hit(row)
+
+    def lookup(self, title):
+        """Row of an article by exact title, or None."""
+        key = title.encode('utf-8')
+        p = search_key(key)
+        # numpy narrows it to the titles sharing the first 8 bytes, then compare whole titles
+        lo = int(np.searchsorted(self.prefixes, p, 'left'))
+        hi = int(np.searchsorted(self.prefixes, p, 'right'))
+        i = bisect_left(self.sorted, key, lo, hi)
+        if i < hi and self.sorted[i] == key:
+            return int(self.titles[i])
+        return None
+
+    def find(self, title):
+        """The article with this title as an OpenSearch style hit, trying it as given and then as MediaWiki would store it."""
+        for candidate in (title, canonical(title)):
+            row = self.lookup(candidate)
+            if row is not None:
+                return self.hit(row)
+        return None
+
+    def prefix(self, prefix, limit=10):
+        """Up to limit (title, page id) in title order that start with prefix."""
+        key = prefix.encode('utf-8')
+        p = search_key(key)
+        i = int(np.searchsorted(self.prefixes, p, 'left'))
+        if len(key) > 8:
+            i = bisect_left(self.sorted, key, i, int(np.searchsorted(self.prefixes, p, 'right')))
+        results = []
+        while i < self.count and len(results) < limit:
+            row = int(self.titles[i])
+            title = self.title_bytes(row)
+            if not title.startswith(key):
+                break
+            results.append((title.decode('utf-8'), int(self.ids[row])))
+            i += 1
+        return results
+
+    def scan(self, chunk=10000):
+        """Yield every article as an OpenSearch style hit in dump order, like scan_wiki."""
+        for start in range(0, self.count, chunk):
+            for row in self.order[start:start + chunk]:
+                yield self.hit(row)
+
+    def close(self):
+        # the arrays are views of the mapping, they have to go before it can be closed
+        self.rows = self.ids = self.streams = self.order = self.titles = self.prefixes = self.sorted = None
+        self.mm.close()
+
+
+# one mapping per process, reopened when the file is rebuilt
+opened = {}
+# sync_wiki and /sync_titles both build into the same tmp file
+build_lock = threading.Lock()
+
+def open_title_index():
+    """The title index if it has been built, else None."""
+    try:
+        key = (os.stat(TITLE_INDEX).st_ino, os.getpid())
+    except FileNotFoundError:
+        return None
+    index = opened.get(key)
+    if index is None:
+        try:
+            index = TitleIndex(TITLE_INDEX)
+        except (OSError, ValueError) as err:
+            print(err, file=sys.stderr)
+            return None
+        opened.clear()
+        opened[key] = index
+    return index
+
+def write_run(directory, chunk):
+    """Sort a chunk of (title, row) and write it out for the merge."""
+    chunk.sort()
+    f = tempfile.NamedTemporaryFile(dir=directory, delete=False)
+    with f:
+        for title, row in chunk:
+            f.write(RUN.pack(len(title), row))
+            f.write(title)
+    return f.name
+
+def read_run(path):
+    with open(path, 'rb') as f:
+        while True:
+            head = f.read(RUN.size)
+            if not head:
+                return
+            length, row = RUN.unpack(head)
+            yield f.read(length), row
+
+def pad(f):
+    # sections start on 8 bytes
+    f.write(b'\0' * (-f.tell() % 8))
+    return f.tell()
+
+def build_title_index(index_filename, dump_size, path=TITLE_INDEX, chunk=TITLE_SORT_CHUNK, job=None):
+    """
+    Turn the multistream index into the table TitleIndex reads.
+    Titles are sorted in runs of chunk and merged from disk, so memory stays around the per row arrays.
+    The new table is built next to the old one and swapped in when done.
+    If another job is building it already this waits for that one.
+    """
+    job = job or Job(None, 'build_title_index')
+    return run_exclusive(build_lock, job, write_title_index, index_filename, dump_size, path, chunk, job)
+
+def write_title_index(index_filename, dump_size, path, chunk, job):
+    job.progress(stage='titles')
+    directory = tempfile.mkdtemp(dir=os.path.dirname(path) or '.')
+    try:
+        ids = array('I')
+        streams = array('I')
+        offsets = array('Q')
+        seeks = array('Q')
+        runs = []
+        pending = []
+        offset = 0
+        with bz2.open(index_filename, 'rb') as f, open(os.path.join(directory, 'blob'), 'wb') as blob:
+            for line in f:
+                l = line.rstrip(b'\n').split(b':', 2)
+                if len(l) < 3:
+                    continue
+                seek = int(l[0])
+                if not seeks or seeks[-1] != seek:
+                    seeks.append(seek)
+                title = l[2]
+                ids.append(int(l[1]))
+                streams.append(len(seeks) - 1)
+                offsets.append(offset)
+                blob.write(LENGTH.pack(len(title)))
+                blob.write(title)
+                offset += 2 + len(title)
+                pending.append((title, len(ids) - 1))
+                if len(pending) >= chunk:
+                    job.check()
+                    runs.append(write_run(directory, pending))
+                    pending = []
+                    job.progress(done=len(ids))
+            if pending:
+                runs.append(write_run(directory, pending))
+                pending = []
+        count = len(ids)
+        print('Read ' + str(count) + ' titles in ' + str(len(seeks)) + ' streams', file=sys.stderr)
+
+        # rows by id, and where each input row ended up
+        id_array = np.frombuffer(ids, dtype='<u4')
+        by_id = np.argsort(id_array, kind='stable')
+        position = np.empty(count, dtype='<u4')
+        position[by_id] = np.arange(count, dtype='<u4')
+        rows = np.empty(count, dtype=ROW)
+        rows['id'] = id_array[by_id]
+        rows['stream'] = np.frombuffer(streams, dtype='<u4')[by_id]
+        rows['title'] = np.frombuffer(offsets, dtype='<u8')[by_id]
+        del ids, streams, offsets, id_array, by_id
+
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as out:
+            out.write(b'\0' * HEADER.size)
+            rows_at = pad(out)
+            out.write(rows.tobytes())
+            del rows
+            streams_at = pad(out)
+            seeks.append(dump_size)
+            out.write(np.frombuffer(seeks, dtype='<u8').tobytes())
+            # input order is dump order
+            order_at = pad(out)
+            out.write(position.tobytes())
+
+            titles_at = pad(out)
+            job.progress(stage='sort titles', total=count)
+            with open(os.path.join(directory, 'prefixes'), 'wb') as prefixes:
+                done = 0
+                sorted_rows = array('I')
+                keys = array('Q')
+                for title, row in heapq.merge(*[read_run(run) for run in runs]):
+                    sorted_rows.append(position[row])
+                    keys.append(prefix_key(title))
+                    if len(sorted_rows) >= chunk:
+                        job.check()
+                        out.write(sorted_rows.tobytes())
+                        prefixes.write(keys.tobytes())
+                        done += len(sorted_rows)
+                        job.progress(done=done)
+                        sorted_rows = array('I')
+                        keys = array('Q')
+                out.write(sorted_rows.tobytes())
+                prefixes.write(keys.tobytes())
+            prefixes_at = pad(out)
+            with open(os.path.join(directory, 'prefixes'), 'rb') as prefixes:
+                shutil.copyfileobj(prefixes, out, 1024 * 1024)
+            blob_at = pad(out)
+            with open(os.path.join(directory, 'blob'), 'rb') as blob:
+                shutil.copyfileobj(blob, out, 1024 * 1024)
+
+            out.seek(0)
+            out.write(HEADER.pack(MAGIC, VERSION, count, len(seeks) - 1, rows_at, streams_at, order_at, titles_at, prefixes_at, blob_at))
+        os.replace(tmp, path)
+        print('Finished building title index', file=sys.stderr)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+if __name__ == '__main__':
+    # offline build: python titleindex.py [index file] [dump file]
+    index_filename = sys.argv[1] if len(sys.argv) > 1 else WIKI_DIR + INDEX.split('/')[-1]
+    dump_filename = sys.argv[2] if len(sys.argv) > 2 else WIKI_DIR + WIKI_URL.split('/')[-1]
+    build_title_index(index_filename, os.path.getsize(dump_filename))
@@ -0,0 +1,90 @@
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from fnmatch import fnmatchcase
+
+from config import *
+
+
+def matches(relative, name, patterns):
+    """A pattern matches either the path relative to the walk root or just the entry name."""
+    return any(fnmatchcase(relative, pattern) or fnmatchcase(name, pattern) for pattern in patterns)
+
+def scan(directory, relative, depth, include, exclude, max_depth, dirs, stat):
+    """
+    List one directory, returns (entries to yield, (path, relative, depth) of subdirectories to walk).
+    The type of each entry comes from the directory listing itself, so nothing is stat'ed unless stat is set.
+    """
+    entries = []
+    subdirectories = []
+    with os.scandir(directory) as it:
+        for entry in it:
+            path = relative + entry.name
+            if exclude and matches(path, entry.name, exclude):
+                continue
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                continue
+            if is_dir:
+                if max_depth is None or depth < max_depth:
+                    subdirectories.append((entry.path, path + '/', depth + 1))
+                if not dirs:
+                    continue
+            elif include and not matches(path, entry.name, include):
+                continue
+            if stat:
+                try:
+                    # cached on the entry, done here so it happens on the worker thread
+                    entry.stat()
+                except OSError:
+                    continue
+            entries.append(entry)
+    return entries, subdirectories
+
+def walk(root, include=None, exclude=None, max_depth=None, dirs=False, stat=False, workers=WALK_WORKERS, onerror=None, relative=''):
+    """
+    Yield an os.DirEntry for every file below root, and every directory too with dirs set.
+    Directories are listed concurrently on workers threads and entries are yielded as each listing comes back,
+    so the order is not stable. include and exclude are lists of globs matched against the path relative to root
+    or the entry name. include only applies to files, an excluded directory is not descended into.
+    relative is root's own path (ending in /) from wherever the patterns are anchored, when that isn't root itself.
+    max_depth 0 stays in root, None goes all the way down.
+    A root that can't be listed raises, subdirectories that can't are reported and skipped,
+    and passed to onerror(path, error) so a caller can tell a missing subtree from a deleted one.
+    """
+    root = os.path.join(root, '')
+    entries, pending = scan(root, relative, 0, include, exclude, max_depth, dirs, stat)
+    yield from entries
+    if not pending:
+        return
+
+    pool = ThreadPoolExecutor(workers)
+    try:
+        running = {}
+        while pending or running:
+            # keep the pool busy without queueing the whole tree at once
+            while pending and len(running) < workers * 2:
+                directory, relative, depth = pending.pop()
+                future = pool.submit(scan, directory, relative, depth, include, exclude, max_depth, dirs, stat)
+                running[future] = directory
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                directory = running.pop(future)
+                try:
+                    entries, subdirectories = future.result()
+                except OSError as err:
+                    print('Failed to list ' + directory + ': ' + str(err), file=sys.stderr)
+                    if onerror is not None:
+                        onerror(directory, err)
+                    continue
+                pending.extend(subdirectories)
+                yield from entries
+    finally:
+        # stopped early, don't finish the walk in the background
+        pool.shutdown(wait=False, cancel_futures=True)
+
+def walk_files(root, **kwargs):
+    """Paths of every file below root, see walk."""
+    for entry in walk(root, **kwargs):
+        yield entry.path
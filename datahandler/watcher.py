@@ -0,0 +1,220 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import sys
+import threading
+import time
+from flask import jsonify
+
+from knowledge import sync_changes
+from walker import walk
+
+from config import *
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+EVENT = struct.Struct('iIII')
+
+
+class Inotify:
+    """Just enough of inotify through ctypes to watch a directory tree."""
+
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.fd = self.libc.inotify_init()
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init failed')
+        self.dirs = {}  # watch descriptor -> directory
+
+    def add_tree(self, root):
+        directories = [root] + [entry.path for entry in walk(root, dirs=True) if entry.is_dir()]
+        for directory in directories:
+            wd = self.libc.inotify_add_watch(self.fd, directory.encode(), WATCH_MASK)
+            if wd < 0:
+                raise OSError(ctypes.get_errno(), 'inotify_add_watch failed on ' + directory)
+            self.dirs[wd] = directory
+
+    def read(self, timeout):
+        """Return (path, mask) events, waiting at most timeout seconds for the first one."""
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        data = os.read(self.fd, 64 * 1024)
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT.unpack_from(data, offset)
+            name = data[offset + EVENT.size:offset + EVENT.size + length].rstrip(b'\0').decode(errors='surrogateescape')
+            offset += EVENT.size + length
+            directory = self.dirs.get(wd)
+            if mask & IN_IGNORED:
+                self.dirs.pop(wd, None)
+                continue
+            if directory is None and not mask & IN_Q_OVERFLOW:
+                continue
+            events.append((os.path.join(directory, name) if directory and name else directory, mask))
+        return events
+
+
+class Watcher:
+    """
+    Keeps knowledge bases in sync with BASE_DIRECTORY as files change.
+    Events are coalesced per file and held until the file has been quiet for WATCH_DEBOUNCE seconds,
+    then each affected directory is synced to the knowledge bases that already hold its files, see sync_changes.
+    Uses inotify where it can and falls back to polling the tree every WATCH_INTERVAL seconds.
+    """
+
+    def __init__(self, root=BASE_DIRECTORY):
+        self.root = root
+        self.pending = {}  # path -> (first event, last event)
+        self.lock = threading.Lock()
+        self.backend = None
+        self.events = 0
+        self.pushes = 0
+        self.errors = 0
+        self.last_lag = None
+        self.snapshot = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def run(self):
+        try:
+            inotify = Inotify()
+            inotify.add_tree(self.root)
+            self.backend = 'inotify'
+        except (OSError, AttributeError) as err:
+            # not linux, or out of watches
+            print('Falling back to polling for file changes: ' + str(err), file=sys.stderr)
+            inotify = None
+            self.backend = 'polling'
+
+        next_poll = 0
+        while True:
+            if inotify is not None:
+                for path, mask in inotify.read(WATCH_DEBOUNCE / 2):
+                    if mask & IN_Q_OVERFLOW:
+                        # the kernel dropped events, look at everything
+                        self.rescan()
+                        continue
+                    if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                        # watch new directories and pick up whatever was already put in them
+                        try:
+                            inotify.add_tree(path)
+                        except OSError as err:
+                            print(err, file=sys.stderr)
+                        self.rescan(path)
+                        continue
+                    if mask & IN_ISDIR and mask & (IN_DELETE | IN_MOVED_FROM):
+                        # everything that was in it is gone too
+                        self.touch(os.path.join(path, ''))
+                        continue
+                    self.touch(path)
+            else:
+                if time.time() >= next_poll:
+                    self.poll()
+                    next_poll = time.time() + WATCH_INTERVAL
+                time.sleep(WATCH_DEBOUNCE / 2)
+            self.flush()
+
+    def touch(self, path):
+        now = time.time()
+        with self.lock:
+            self.events += 1
+            first = self.pending.get(path, (now, now))[0]
+            self.pending[path] = (first, now)
+
+    def rescan(self, root=None):
+        root = root or self.root
+        self.touch(os.path.join(root, ''))
+        try:
+            for entry in walk(root, include=SYNC_INCLUDE, exclude=SYNC_EXCLUDE, dirs=True):
+                self.touch(os.path.join(entry.path, '') if entry.is_dir() else entry.path)
+        except FileNotFoundError:
+            # already gone again
+            pass
+
+    def poll(self):
+        """Compare the tree against the last walk and turn the differences into events."""
+        snapshot = {}
+        failed = []
+        try:
+            for entry in walk(self.root, include=SYNC_INCLUDE, exclude=SYNC_EXCLUDE, stat=True, onerror=lambda path, err: failed.append(os.path.join(path, ''))):
+                stat = entry.stat()
+                snapshot[entry.path] = (stat.st_size, stat.st_mtime_ns)
+        except FileNotFoundError:
+            pass
+        if failed and self.snapshot is not None:
+            # a directory we couldn't list this time keeps what we last saw in it, rather than looking emptied
+            failed = tuple(failed)
+            snapshot.update((path, value) for path, value in self.snapshot.items() if path.startswith(failed))
+        if self.snapshot is not None:
+            for path in snapshot.keys() | self.snapshot.keys():
+                if snapshot.get(path) != self.snapshot.get(path):
+                    self.touch(path)
+        self.snapshot = snapshot
+
+    def flush(self):
+        """Push every file that has gone quiet, one sync per directory."""
+        now = time.time()
+        with self.lock:
+            ready = [path for path, (_, last) in self.pending.items() if now - last >= WATCH_DEBOUNCE]
+            firsts = [self.pending.pop(path)[0] for path in ready]
+        if not ready:
+            return
+
+        directories = set(os.path.dirname(path) for path in ready)
+        for directory in directories:
+            try:
+                sync_changes(directory)
+                self.pushes += 1
+            except Exception as err:
+                print('Failed to sync ' + directory + ': ' + str(err), file=sys.stderr)
+                self.errors += 1
+        self.last_lag = time.time() - min(firsts)
+
+    def metrics(self):
+        now = time.time()
+        with self.lock:
+            depth = len(self.pending)
+            oldest = min((first for first, _ in self.pending.values()), default=None)
+        return {
+            'backend': self.backend,
+            'queue_depth': depth,
+            'oldest_pending_seconds': None if oldest is None else now - oldest,
+            'last_lag_seconds': self.last_lag,
+            'events': self.events,
+            'pushes': self.pushes,
+            'errors': self.errors
+        }
+
+
+watcher = None
+
+def start_watcher():
+    global watcher
+    if watcher is None:
+        watcher = Watcher()
+        watcher.start()
+    return watcher
+
+def watcher_routes(app):
+    @app.route('/watcher', methods=['GET'])
+    def watcher_metrics():
+        if watcher is None:
+            return jsonify({"error": "Watcher is not running"}), 404
+        return jsonify(watcher.metrics())
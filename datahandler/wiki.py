@@ -1,19 +1,30 @@
 from flask import request, jsonify, render_template, redirect, make_response
 
 import json
+import multiprocessing
 import xml.etree.ElementTree as ET
 import re
 import mwparserfromhell
 import html2text
+from html2text.utils import escape_md_section as md_escape
 import bz2
+import hashlib
 from html import escape
-import requests
+import client
 import os
 import sys
 import time
-from opensearch import get_opensearch, create_opensearch
+import threading
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from opensearch import get_opensearch, create_opensearch, delete_opensearch, migrate_opensearch, get_opensearch_settings, update_opensearch_settings, bulk
 from knowledge import list_knowledge, create_knowledge, upload_file, get_all_files
 from auth import auth_header
+from cache import LRUCache, RenderCache
+from manifest import Manifest
+from jobs import Job, submit_job
+from redirects import resolve_redirect, build_redirects
+from titleindex import open_title_index, build_title_index
 
 from config import *
 def wiki_index(search_term='*'):
@@ -26,7 +37,7 @@ def wiki_index(search_term='*'):
         }
     }
     try:
-        response = requests.get(url, json=data)
+        response = client.get(url, json=data)
         return response.json()
     except Exception as err:
         print(err, file=sys.stderr)
@@ -38,70 +49,134 @@ def wiki_routes(app):
     @app.route('/wiki', methods=['GET'])
     def get_wiki():
         # Get query parameters for pagination
-        page = int(request.args.get('page', 1))  # Default to page 1
-        size = int(request.args.get('size', 99))  # Default to 99 results per page
+        try:
+            page = int(request.args.get('page', 1))  # Default to page 1
+            size = int(request.args.get('size', 99))  # Default to 99 results per page
+            # cursor from the last page, lets Next skip the from/size paging
+            after = request.args.get('after')
+            after = json.loads(after) if after else None
+        except ValueError:
+            return jsonify({"error": "Invalid page, size or cursor"}), 400
+        if page < 1 or size < 1 or (after is not None and not isinstance(after, list)):
+            return jsonify({"error": "Invalid page, size or cursor"}), 400
         search_term = request.args.get('search', '')
 
-        response = wiki_search(search_term, page, size)
+        response = wiki_search(search_term, page, size, after)
+        if response.status_code == 400 and after is not None:
+            # a cursor that doesn't fit the sort
+            return jsonify({"error": "Invalid cursor"}), 400
 
         # Extract results and pagination info
         results = response.json().get('hits', {}).get('hits', [])
         has_more = len(results) == size
+        after = json.dumps(results[-1]['sort']) if results and 'sort' in results[-1] else None
 
         # Render the results page
-        return render_template('results.html', search=search_term, results=results, page=page, has_more=has_more)
+        return render_template('results.html', search=search_term, results=results, page=page, has_more=has_more, after=after)
+
+    @app.route('/wiki/suggest', methods=['GET'])
+    def suggest_wiki():
+        q = request.args.get('q', '')
+        try:
+            size = min(max(int(request.args.get('size', SUGGEST_SIZE)), 1), SUGGEST_MAX)
+        except ValueError:
+            size = SUGGEST_SIZE
+        return jsonify(suggest_titles(q, size))
 
     @app.route('/wiki/<string:title>', methods=['GET'])
     def get_wiki_article(title):
-        response = wiki_search(title, size=1)
-
-        results = response.json().get('hits', {}).get('hits', [])
-        if not results:
+        article = find_title(title)
+        if article is None:
             return jsonify({"error": "Article not found"}), 404
 
-        article = results[0]
+        # skip straight to the article if this title is a redirect
+        target = resolve_redirect(article['_id'])
+        if target is not None:
+            return redirect('/view/' + str(target))
         return redirect('/view/' + article['_id'])
 
     @app.route('/view/<int:id>', methods=['GET'])
     def view_wiki(id):
-        # get this article and the next to calculate the length
-        d = DB_URL + '/wikipedia/_doc/' + str(id)
-        response = requests.get(d)
-        if response.status_code != 200:
-            print(response.json(), file=sys.stderr)
-            return jsonify({"error": "Failed to fetch data from OpenSearch"}), 500
-        response = response.json()
-        seek = response['_source']['seek'] 
-        title = response['_source']['title']
-        # remove newlines and leading/ttrailing whitespace from title for cleaner display
-        title = title.replace('\n', ' ').strip() 
-        id = response['_id']
-        
-        text = get_wikitext(WIKI_DIR + WIKI_URL.split('/')[-1], seek, id, title)
-
-        if text is None:
-            print('Failed to get wikitext for article: ' + str(id), file=sys.stderr)
-            return jsonify({"error": "No text found for this article " + str(title)}), 404
-        text = format_wikitext(text)
-
-        if request.args.get('markdown', 'false').lower() == 'true':
+        target = resolve_redirect(id)
+        if target is not None:
+            id = target
+
+        markdown = request.args.get('markdown', 'false').lower() == 'true'
+        kind = 'md' if markdown else 'html'
+        version = render_version()
+        etag = None
+        if version is not None:
+            etag = version + '-' + str(id) + '-' + kind
+            # the browser already has this exact rendering
+            if etag in request.if_none_match:
+                response = make_response('', 304)
+                response.set_etag(etag)
+                return response
+
+        cached = render_cache.get(version, str(id) + '.' + kind) if version else None
+        if cached is not None:
+            title, text = cached.split('\n', 1)
+        else:
+            response = get_article(id)
+            if response is None:
+                return jsonify({"error": "Failed to fetch data from OpenSearch"}), 500
+            seek = response['_source']['seek']
+            end = response['_source'].get('end')
+            title = response['_source']['title']
+            # remove newlines and leading/ttrailing whitespace from title for cleaner display
+            title = title.replace('\n', ' ').strip()
+
+            text = get_wikitext(WIKI_DIR + WIKI_URL.split('/')[-1], seek, response['_id'], title, end=end)
+
+            if text is None:
+                print('Failed to get wikitext for article: ' + str(id), file=sys.stderr)
+                return jsonify({"error": "No text found for this article " + str(title)}), 404
+            # straight to markdown, no html in between
+            text = format_markdown(text, title) if markdown else format_wikitext(text)
+            if version:
+                render_cache.put(version, str(id) + '.' + kind, title + '\n' + text)
+
+        if markdown:
             # return as text file
             # Create a text/plain response with the markdown content
-            markdown_text = html_to_markdown(text, title)  # Convert HTML to Markdown
-            response = make_response(markdown_text)
+            response = make_response(text)
             response.headers['Content-Type'] = 'text/plain; charset=utf-8'
             response.headers['Content-Disposition'] = f'attachment; filename="{title.replace(" ", "_")}.md"'
-            # Return the response to download the markdown file
-            return response
-
-        return render_template('article.html', article=text)
+        else:
+            response = make_response(render_template('article.html', article=text))
+        if etag:
+            response.set_etag(etag)
+        return response
 
 
     @app.route('/sync_wiki', methods=['GET'])
     def sync_wiki_route():
-        return jsonify(sync_wiki())
+        # runs in the background, poll /jobs/<id> for progress
+        job = submit_job('sync_wiki', 'Sync Wikipedia', sync_wiki)
+        return jsonify(job.to_dict()), 202
+
+    @app.route('/sync_redirects', methods=['GET'])
+    def sync_redirects_route():
+        job = submit_job('sync_redirects', 'Build redirects', build_redirects, WIKI_DIR + WIKI_URL.split('/')[-1], WIKI_DIR + INDEX.split('/')[-1])
+        return jsonify(job.to_dict()), 202
+
+    @app.route('/sync_titles', methods=['GET'])
+    def sync_titles_route():
+        job = submit_job('sync_titles', 'Build title index', build_title_index, WIKI_DIR + INDEX.split('/')[-1], os.path.getsize(WIKI_DIR + WIKI_URL.split('/')[-1]))
+        return jsonify(job.to_dict()), 202
 
-def wiki_search(search_term = '', page = 1, size = 99):
+    @app.route('/wiki_stats', methods=['GET'])
+    def wiki_stats():
+        return jsonify({"block_cache": block_cache.stats(), "render_cache": render_cache.stats(), "suggest_cache": suggest_cache.stats()})
+
+# tiebreaker for sorting articles, an index from before page_id was mapped sorts as if every page_id were missing
+PAGE_ID_SORT = {"page_id": {"order": "asc", "unmapped_type": "long"}}
+
+def wiki_search(search_term = '', page = 1, size = 99, search_after = None):
+    """
+    Search article titles, or list everything when there is no search term.
+    Pass the sort values of the last hit as search_after to get the page after it without paying for a deep from.
+    """
     
     # Calculate the 'from' parameter
     from_param = size * (page - 1)
@@ -115,7 +190,8 @@ def wiki_search(search_term = '', page = 1, size = 99):
             "size": size,
             "query": {
                 "match_all": {}
-            }
+            },
+            "sort": [{"seek": "asc"}, PAGE_ID_SORT]
         }
     else:
         query = {
@@ -125,11 +201,16 @@ def wiki_search(search_term = '', page = 1, size = 99):
                 "match": {
                     "title": search_term
                 }
-            }
+            },
+            "sort": [{"_score": "desc"}, PAGE_ID_SORT]
         }
 
+    if search_after is not None:
+        del query["from"]
+        query["search_after"] = search_after
+
     # Send the request to OpenSearch
-    response = requests.get(url, json=query)
+    response = client.get(url, json=query)
     if response.status_code != 200:
         print(response.json(), file=sys.stderr)
         return response
@@ -137,168 +218,440 @@ def wiki_search(search_term = '', page = 1, size = 99):
     # Return the paginated results
     return response
 
-def get_wikitext(dump_filename, offset, page_id=None, title=None, namespace_id=None, block_size=256*1024, r = 0):
-    """Extract and clean wikitext from a multistream dump file."""
-    unzipper = bz2.BZ2Decompressor()
+def find_title(title):
+    """
+    The article with this title, straight from the title index when it has it exactly,
+    then on title.keyword (ignoring case and surrounding whitespace),
+    falling back to the best full text match when nothing has that title.
+    """
+    index = open_title_index()
+    if index is not None:
+        article = index.find(title)
+        if article is not None:
+            return article
 
-    # Read the compressed stream, decompress the data
-    uncompressed_data = b""
-    with open(dump_filename, "rb") as infile:
-        infile.seek(int(offset))
-        iter = 0
-        maxi = 100
+    title = title.replace('_', ' ').strip()
+    query = {
+        "size": 10,
+        "query": {
+            "term": {
+                "title.keyword": title
+            }
+        }
+    }
+    try:
+        response = client.post(DB_URL + '/wikipedia/_search', json=query, idempotent=True)
+        hits = response.json().get('hits', {}).get('hits', []) if response.status_code == 200 else []
+    except Exception as err:
+        print(err, file=sys.stderr)
+        hits = []
+    if hits:
+        # titles differing only by case are usually an article and a redirect to it, prefer the exact one
+        return next((hit for hit in hits if hit['_source']['title'].strip() == title), hits[0])
+
+    response = wiki_search(title, size=1)
+    results = response.json().get('hits', {}).get('hits', [])
+    return results[0] if results else None
+
+# (when, suggestions) per prefix, typing the same few letters again shouldn't go back to opensearch
+suggest_cache = LRUCache(SUGGEST_CACHE_BYTES, sizeof=lambda entry: 64 + sum(96 + len(s['title']) for s in entry[1]))
 
+def suggest_titles(prefix, size=SUGGEST_SIZE):
+    """
+    Up to size {"id", "title"} whose title starts with prefix, for search as you type.
+    The title index answers when it has enough titles starting with the prefix as typed or capitalised,
+    otherwise the completion suggester on title.suggest does, which ignores case.
+    """
+    prefix = prefix.replace('_', ' ').lstrip()
+    if not prefix:
+        return []
+    key = (prefix, size)
+    cached = suggest_cache.get(key)
+    if cached is not None and time.monotonic() - cached[0] < SUGGEST_CACHE_TTL:
+        return cached[1]
+
+    suggestions = []
+    index = open_title_index()
+    if index is not None:
+        seen = set()
+        for candidate in dict.fromkeys((prefix, prefix[:1].upper() + prefix[1:])):
+            for title, page_id in index.prefix(candidate, size):
+                if page_id not in seen:
+                    seen.add(page_id)
+                    suggestions.append({"id": str(page_id), "title": title})
+        suggestions = suggestions[:size]
+
+    if len(suggestions) < size:
+        query = {
+            "_source": ["title"],
+            "suggest": {
+                "titles": {
+                    "prefix": prefix,
+                    "completion": {
+                        "field": "title.suggest",
+                        "size": size,
+                        "skip_duplicates": True
+                    }
+                }
+            }
+        }
+        try:
+            # nobody waits on a retry while typing, the next keystroke asks again
+            response = client.post(DB_URL + '/wikipedia/_search', json=query, retries=0, idempotent=True, timeout=(HTTP_CONNECT_TIMEOUT, SUGGEST_TIMEOUT))
+            if response.status_code != 200:
+                print(response.json(), file=sys.stderr)
+                return suggestions
+            options = response.json().get('suggest', {}).get('titles', [{}])[0].get('options', [])
+        except Exception as err:
+            print(err, file=sys.stderr)
+            return suggestions
+        if len(options) > len(suggestions):
+            suggestions = [{"id": option['_id'], "title": option['_source']['title']} for option in options]
+
+    suggest_cache.put(key, (time.monotonic(), suggestions))
+    return suggestions
+
+def scan_wiki(size = 1000, keep_alive = '5m'):
+    """
+    Yield every document in the wikipedia index in stream order.
+    Pages through a point in time with search_after, so each page costs the same no matter how deep we are.
+    """
+    response = client.post(DB_URL + '/wikipedia/_search/point_in_time', params={'keep_alive': keep_alive}, idempotent=True)
+    if response.status_code != 200:
+        print(response.json(), file=sys.stderr)
+        raise Exception('Failed to open point in time: ' + str(response))
+    pit = response.json()['pit_id']
+
+    try:
+        search_after = None
         while True:
-            iter += 1
-            if iter > maxi:
-                print('Failed to get wikitext for article: ' + str(page_id) + ' - ' + str(title), file=sys.stderr)
-                return None
+            query = {
+                "size": size,
+                "query": {
+                    "match_all": {}
+                },
+                "pit": {
+                    "id": pit,
+                    "keep_alive": keep_alive
+                },
+                # a stream's articles share their seek, page_id tells them apart from doc values where _id would need fielddata
+                # no unmapped_type, an index without page_id would quietly lose all but one article per stream
+                "sort": [{"seek": "asc"}, {"page_id": "asc"}]
+            }
+            if search_after is not None:
+                query["search_after"] = search_after
+
+            response = client.post(DB_URL + '/_search', json=query, idempotent=True)
+            if response.status_code != 200:
+                print(response.json(), file=sys.stderr)
+                raise Exception('Failed to scan wikipedia: ' + str(response))
+            response = response.json()
+            # the pit id can change between pages
+            pit = response.get('pit_id', pit)
+
+            hits = response.get('hits', {}).get('hits', [])
+            if not hits:
+                return
+            yield from hits
+            search_after = hits[-1]['sort']
+    finally:
+        client.delete(DB_URL + '/_search/point_in_time', json={"pit_id": [pit]})
+
+def count_wiki():
+    index = open_title_index()
+    if index is not None:
+        return len(index)
+    try:
+        return client.get(DB_URL + '/wikipedia/_count').json()['count']
+    except Exception as err:
+        print(err, file=sys.stderr)
+        return None
+
+def get_article(id):
+    """Fetch the index document for a page id, from the title index if it's been built."""
+    index = open_title_index()
+    if index is not None:
+        article = index.locate(id)
+        if article is not None:
+            return article
+    response = client.get(DB_URL + '/wikipedia/_doc/' + str(id))
+    if response.status_code != 200:
+        print(response.json(), file=sys.stderr)
+        return None
+    return response.json()
+
+# bump when format_wikitext or format_markdown change what they produce, so cached articles are rendered again
+RENDER_VERSION = 3
+
+render_cache = RenderCache(RENDER_CACHE_DIR, RENDER_CACHE_BYTES)
+
+def render_version():
+    """Version for rendered articles, moves whenever the dump is replaced or the rendering changes. None without a dump."""
+    try:
+        stat = os.stat(WIKI_DIR + WIKI_URL.split('/')[-1])
+    except FileNotFoundError:
+        return None
+    return '%d-%x-%x' % (RENDER_VERSION, stat.st_size, stat.st_mtime_ns)
+
+def iter_stream(dump_filename, offset, end=None, block_size=256*1024):
+    """Yield decompressed pieces of the bz2 stream that starts at offset in the multistream dump."""
+    offset = int(offset)
+    unzipper = bz2.BZ2Decompressor()
+    with open(dump_filename, "rb") as infile:
+        if end is not None:
+            # the index tells us where the next stream starts, so read exactly this stream in one go
+            compressed_data = os.pread(infile.fileno(), int(end) - offset, offset)
+            # but hand the output out in pieces so the parser can stop early
+            while not unzipper.eof:
+                piece = unzipper.decompress(compressed_data, block_size)
+                compressed_data = b""
+                if piece:
+                    yield piece
+                elif unzipper.needs_input:
+                    break
+            return
+
+        # older index documents don't have an end, read until the decompressor hits the end of the stream
+        infile.seek(offset)
+        for _ in range(100):
             compressed_data = infile.read(block_size)
             if not compressed_data:  # End of file
-                break
-            uncompressed_data += unzipper.decompress(compressed_data)
+                return
+            yield unzipper.decompress(compressed_data)
             if unzipper.eof:  # End of the compressed stream
-                break
-
-    # Decode and parse the XML
-    uncompressed_text = uncompressed_data.decode("utf-8")
-    xml_data = "<root>" + uncompressed_text + "</root>"
-    root = ET.fromstring(xml_data)
-    for page in root.findall("page"):
-        pTitle = page.find("title").text.replace('\n', ' ').strip()
-        if title is not None and str(title).strip() != str(pTitle):
-            continue
-        if namespace_id is not None and namespace_id != int(page.find("ns").text):
-            continue
-        if page_id is not None and int(page_id) != int(page.find("id").text):
-            continue
-
-        # Extract wikitext
-        revision = page.find("revision")
-        wikitext = revision.find("text").text
-
-        # Handle redirects
-        redirect_match = re.match(r"#REDIRECT \[\[(.*?)\]\]", wikitext, re.IGNORECASE)
-        if redirect_match and r < 6:
-            redirect_title = redirect_match.group(1)
-            # Handle fetching the redirected article (not implemented here)
-            # search for the redirected article
-            response = wiki_search(redirect_title, size=1)
-            results = response.json().get('hits', {}).get('hits', [])
-            if results:
-                article = results[0]
-                return get_wikitext(WIKI_DIR + WIKI_URL.split('/')[-1], article['_source']['seek'], article['_id'], article['_source']['title'], r = (r + 1))
-            else:
-                print(f"Redirected article not found: {redirect_title}", file=sys.stderr)
-                return None            
-        return wikitext
-    
-    # If no matching page is found
-    print(f"No matching page found for title: {title}, page_id: {page_id}, namespace_id: {namespace_id}", file=sys.stderr)
-    return None
+                return
+        print('Gave up reading stream at ' + str(offset), file=sys.stderr)
 
+def iter_pages(dump_filename, offset, end=None):
+    """
+    Yield (page_id, wikitext) for each page in the stream at offset.
+    The XML is parsed as it is decompressed and each page is dropped once it has been read.
+    """
+    parser = ET.XMLPullParser(events=("start", "end"))
+    # a stream is a run of <page> elements with no root of its own
+    parser.feed(b"<root>")
+    root = None
+    stream = iter_stream(dump_filename, offset, end)
+    try:
+        for piece in stream:
+            parser.feed(piece)
+            for event, elem in parser.read_events():
+                if root is None:
+                    root = elem
+                if event == "end" and elem.tag == "page":
+                    yield int(elem.findtext("id")), elem.findtext("revision/text") or ''
+                    root.clear()
+    finally:
+        # let go of the file and the decompressor now, not whenever the generator gets collected
+        stream.close()
 
-def format_wikitext(wikitext):
+class Block:
     """
-    Convert wikitext to HTML using mwparserfromhell.
+    The pages of one dump stream, parsed lazily.
+    Parsing stops as soon as the requested pages have been seen. The reader is closed then, so a cached block holds
+    only its pages and no open file or decompressor, and a later miss reads the stream again past what we already have.
     """
-    # Parse the wikitext
-    wikicode = mwparserfromhell.parse(wikitext)
 
-    # Convert the parsed wikitext to HTML
-    html_output = ""
-    for node in wikicode.nodes:
-        node_type = node.__class__.__name__
+    def __init__(self, dump_filename, offset, end=None):
+        self.dump_filename = dump_filename
+        self.offset = offset
+        self.end = end
+        self.pages = {}
+        self.text_size = 0
+        self.size = sys.getsizeof(self.pages)
+        self.complete = False
+        self.lock = threading.Lock()
 
-        if node_type == "Text":
-            html_output += escape(str(node))
-        elif node_type == "Template":
-            # ignore templates for now
-            continue
-            # html_output += f"<span class='template'>{escape(str(node))}</span>"
-        elif node_type == "Wikilink":
-            target = escape(str(node.title))
-            text = escape(str(node.text)) if node.text else target
-
-            if '|' in text:
-                text = text.split('|')[-1]
-            
-            if 'thumb' in text.split('|')[0]:
-                # handle links [[]] in the 
-                for link in re.findall(r'\[\[(.*?)\]\]', text):
-                    # if there are any links inside the link text, we need to handle them
-                    text = text.replace(link, f"<a class='wikilink' href='/wiki/{link}'>{link}</a>")
-
-                html_output += f"<a class='img' href='/wiki/{target}'>🖼️</a> {text}"
-
-            else:
-                html_output += f"<a class='wikilink' href='/wiki/{target}'>{text}</a>"
-        elif node_type == "ExternalLink":
-            url = escape(str(node.url))
-            text = escape(str(node.title)) if node.title else url
-            html_output += f"<a class='external' href='{url}'>{text}</a>"
-        elif node_type == "Heading":
-            level = node.level
-            heading_text = escape(str(node.title.strip_code()))
-            html_output += f"<h{level}>{heading_text}</h{level}>"
-        elif node_type == "Tag":
-            if node.tag == "ref":
-                # Parse the content inside the <ref> tag
-                ref_content = str(node.contents.strip_code())
-                citation_html = ""
-
-                # Check if the content is a citation template
-                if ref_content.startswith("{{cite"):
-                    # Extract citation fields
-                    fields = {}
-                    for part in ref_content.strip("{}").split("|"):
-                        if "=" in part:
-                            key, value = part.split("=", 1)
-                            fields[key.strip()] = value.strip()
-
-                    # Build the citation HTML
-                    url = fields.get("url", "")
-                    title = fields.get("title", "Untitled")
-                    author = f"{fields.get('first', '')} {fields.get('last', '')}".strip()
-                    date = fields.get("date", "")
-                    website = fields.get("website", "")
-
-                    citation_html = f"<cite>"
-                    if url:
-                        citation_html += f"<a class='cite' href='{escape(url)}'>{escape(title)}</a>"
-                    else:
-                        citation_html += escape(title)
-                    if author:
-                        citation_html += f" by {escape(author)}"
-                    if date:
-                        citation_html += f", {escape(date)}"
-                    if website:
-                        citation_html += f" ({escape(website)})"
-                    citation_html += f"</cite>"
+    def load(self, page_ids):
+        """Parse until every one of page_ids has been seen, or the stream ends."""
+        with self.lock:
+            missing = set(page_ids) - self.pages.keys()
+            if not missing or self.complete:
+                return
+            reader = iter_pages(self.dump_filename, self.offset, self.end)
+            try:
+                for id, text in reader:
+                    if id in self.pages:
+                        continue
+                    self.pages[id] = text
+                    self.text_size += sys.getsizeof(text)
+                    missing.discard(id)
+                    if not missing:
+                        break
                 else:
-                    # If not a citation template, output raw content
-                    citation_html = escape(ref_content)
-
-                # Wrap the citation in a reference span
-                html_output += f" <sub class='reference'>{citation_html}</sub>"
-            else:
-                html_output += escape(str(node))
-        elif node_type == "Bold":
-            bold_text = escape(str(node.strip_code()))
-            html_output += f"<b>{bold_text}</b>"
-        elif node_type == "Italic":
-            html_output += f"<i>{escape(str(node))}</i>"
-        elif node_type == "File":
-            file_name = escape(str(node.title))
-            finaltext = file_name.split('|')[-1]
-            # handle links [[]] in the 
-            for link in re.findall(r'\[\[(.*?)\]\]', finaltext):
-                # if there are any links inside the link text, we need to handle them
-                finaltext = finaltext.replace(link, f"<a class='wikilink' href='/wiki/{link}'>{link}</a>")
-            html_output += f"<ins>{finaltext}</ins>"
+                    self.complete = True
+            except ET.ParseError as err:
+                print('Failed to parse stream: ' + str(err), file=sys.stderr)
+                self.complete = True
+            finally:
+                reader.close()
+            self.size = sys.getsizeof(self.pages) + self.text_size
+
+    def get(self, page_id):
+        self.load([page_id])
+        return self.pages.get(page_id)
+
+def block_size(block):
+    """Approximate memory held by a block, used to keep the block cache within its budget."""
+    return block.size
+
+# streams keyed by (dump, offset), shared by /view and the sync export since both walk neighbouring articles
+block_cache = LRUCache(BLOCK_CACHE_BYTES, sizeof=block_size)
+
+def get_block(dump_filename, offset, end=None):
+    """Return the Block for the stream at offset, reusing the cached one if we have it."""
+    key = (dump_filename, int(offset))
+    block = block_cache.get(key)
+    if block is None:
+        block = Block(dump_filename, offset, end)
+        block_cache.put(key, block)
+    return block
+
+def get_wikitext(dump_filename, offset, page_id, title=None, end=None, r = 0, block=None):
+    """
+    Extract and clean wikitext from a multistream dump file.
+    Pass the stream's block to read from it instead of the block cache, redirects to other streams then don't use the cache either.
+    """
+    if block is None:
+        block = get_block(dump_filename, offset, end)
+        wikitext = block.get(int(page_id))
+        # the block may have grown while we parsed up to this page
+        block_cache.resize((dump_filename, int(offset)))
+        cached = True
+    else:
+        wikitext = block.get(int(page_id))
+        cached = False
+    if wikitext is None:
+        # If no matching page is found
+        print(f"No matching page found for title: {title}, page_id: {page_id}", file=sys.stderr)
+        return None
+
+    # Handle redirects
+    redirect_match = re.match(r"#REDIRECT \[\[(.*?)\]\]", wikitext, re.IGNORECASE)
+    if redirect_match and r < 6:
+        # the redirect table already knows the final article
+        target = resolve_redirect(page_id)
+        if target is not None:
+            article = get_article(target)
+            if article is not None:
+                return get_wikitext(WIKI_DIR + WIKI_URL.split('/')[-1], article['_source']['seek'], article['_id'], article['_source']['title'], end=article['_source'].get('end'), r = 6,
+                                    block=None if cached else Block(WIKI_DIR + WIKI_URL.split('/')[-1], article['_source']['seek'], article['_source'].get('end')))
+
+        redirect_title = redirect_match.group(1)
+        # look the redirected article up by title, links to a section still land on the article
+        article = find_title(redirect_title.split('#')[0])
+        if article is not None:
+            return get_wikitext(WIKI_DIR + WIKI_URL.split('/')[-1], article['_source']['seek'], article['_id'], article['_source']['title'], end=article['_source'].get('end'), r = (r + 1),
+                                block=None if cached else Block(WIKI_DIR + WIKI_URL.split('/')[-1], article['_source']['seek'], article['_source'].get('end')))
         else:
-            html_output += escape(str(node))
+            print(f"Redirected article not found: {redirect_title}", file=sys.stderr)
+            return None
+    return wikitext
+
+
+# [[links]] left inside the text of image links and file captions
+LINK_PATTERN = re.compile(r'\[\[(.*?)\]\]')
+
+def link_inner_links(text):
+    # if there are any links inside the link text, we need to handle them
+    for link in LINK_PATTERN.findall(text):
+        text = text.replace(link, f"<a class='wikilink' href='/wiki/{link}'>{link}</a>")
+    return text
+
+def render_node(node, out):
+    out.append(escape(str(node)))
+
+def render_text(node, out):
+    out.append(escape(node.value))
+
+def render_template_node(node, out):
+    # ignore templates for now
+    pass
+
+def render_wikilink(node, out):
+    target = escape(str(node.title))
+    text = escape(str(node.text)) if node.text else target
+
+    if '|' in text:
+        text = text.split('|')[-1]
+
+    if 'thumb' in text.split('|')[0]:
+        out.append(f"<a class='img' href='/wiki/{target}'>🖼️</a> {link_inner_links(text)}")
+    else:
+        out.append(f"<a class='wikilink' href='/wiki/{target}'>{text}</a>")
+
+def render_external_link(node, out):
+    url = escape(str(node.url))
+    text = escape(str(node.title)) if node.title else url
+    out.append(f"<a class='external' href='{url}'>{text}</a>")
 
+def render_heading(node, out):
+    level = node.level
+    out.append(f"<h{level}>{escape(str(node.title.strip_code()))}</h{level}>")
+
+def render_citation(ref_content, out):
+    # Extract citation fields
+    fields = {}
+    for part in ref_content.strip("{}").split("|"):
+        if "=" in part:
+            key, value = part.split("=", 1)
+            fields[key.strip()] = value.strip()
+
+    url = fields.get("url", "")
+    title = fields.get("title", "Untitled")
+    author = f"{fields.get('first', '')} {fields.get('last', '')}".strip()
+    date = fields.get("date", "")
+    website = fields.get("website", "")
+
+    out.append("<cite>")
+    if url:
+        out.append(f"<a class='cite' href='{escape(url)}'>{escape(title)}</a>")
+    else:
+        out.append(escape(title))
+    if author:
+        out.append(f" by {escape(author)}")
+    if date:
+        out.append(f", {escape(date)}")
+    if website:
+        out.append(f" ({escape(website)})")
+    out.append("</cite>")
+
+def render_tag(node, out):
+    if node.tag != "ref":
+        out.append(escape(str(node)))
+        return
+    # Wrap the citation in a reference span
+    ref_content = str(node.contents.strip_code())
+    out.append(" <sub class='reference'>")
+    if ref_content.startswith("{{cite"):
+        render_citation(ref_content, out)
+    else:
+        # If not a citation template, output raw content
+        out.append(escape(ref_content))
+    out.append("</sub>")
+
+# exact node type -> renderer, anything else is written out escaped
+RENDERERS = {
+    mwparserfromhell.nodes.Text: render_text,
+    mwparserfromhell.nodes.Template: render_template_node,
+    mwparserfromhell.nodes.Wikilink: render_wikilink,
+    mwparserfromhell.nodes.ExternalLink: render_external_link,
+    mwparserfromhell.nodes.Heading: render_heading,
+    mwparserfromhell.nodes.Tag: render_tag,
+}
+
+def render_wikicode(wikicode):
+    """Each top level node is handed to its renderer in RENDERERS, which appends to one list joined at the end."""
+    out = []
+    for node in wikicode.nodes:
+        RENDERERS.get(type(node), render_node)(node, out)
+    return ''.join(out)
+
+def format_wikitext(wikitext):
+    """
+    Convert wikitext to HTML using mwparserfromhell.
+    """
+    html_output = render_wikicode(mwparserfromhell.parse(wikitext))
     if html_output == "":
         return "No content found"
     return html_output
@@ -316,7 +669,342 @@ def html_to_markdown(html, title):
 
     return markdown_output
 
-def sync_wiki(reindex=False):
+# markdown renderers, the same walk as RENDERERS but written straight to markdown instead of html for html2text to convert.
+# Output is what html2text made of the html: links are just their text, and html2text escapes and collapses whitespace
+# in each run of text between two tags on its own, so the renderers mark where the html had a tag (TAG)
+# or a heading started or ended (BLOCK) and finish_markdown does the same per run.
+TAG = '\x01'
+BLOCK = '\x02'
+MARKUP = re.compile('([' + TAG + BLOCK + '])')
+# html2text sees the entities escape() writes as text of their own, and handles the text either side separately
+ENTITY_CHARS = re.compile(r'''([&<>"'])''')
+WHITESPACE = re.compile(r'\s+')
+
+def markdown_node(node, out):
+    out.append(str(node))
+
+def markdown_text_node(node, out):
+    out.append(node.value)
+
+def markdown_wikilink(node, out):
+    text = str(node.text) if node.text else str(node.title)
+
+    if '|' in text:
+        text = text.split('|')[-1]
+
+    if 'thumb' in text.split('|')[0]:
+        # [[links]] in the caption became links of their own
+        for link in LINK_PATTERN.findall(text):
+            text = text.replace(link, TAG + link + TAG)
+        out.append(TAG + '🖼️' + TAG + ' ' + text)
+    else:
+        out.append(TAG + text + TAG)
+
+def markdown_external_link(node, out):
+    out.append(TAG + (str(node.title) if node.title else str(node.url)) + TAG)
+
+def markdown_heading(node, out):
+    out.append(BLOCK + '#' * node.level + ' ' + TAG + str(node.title.strip_code()) + BLOCK)
+
+def markdown_citation(ref_content, out):
+    fields = {}
+    for part in ref_content.strip("{}").split("|"):
+        if "=" in part:
+            key, value = part.split("=", 1)
+            fields[key.strip()] = value.strip()
+
+    url = fields.get("url", "")
+    title = fields.get("title", "Untitled")
+    author = f"{fields.get('first', '')} {fields.get('last', '')}".strip()
+    date = fields.get("date", "")
+    website = fields.get("website", "")
+
+    out.append(TAG)
+    out.append(TAG + title + TAG if url else title)
+    if author:
+        out.append(f" by {author}")
+    if date:
+        out.append(f", {date}")
+    if website:
+        out.append(f" ({website})")
+    out.append(TAG)
+
+def markdown_tag(node, out):
+    if node.tag != "ref":
+        out.append(str(node))
+        return
+    ref_content = str(node.contents.strip_code())
+    out.append(" " + TAG)
+    if ref_content.startswith("{{cite"):
+        markdown_citation(ref_content, out)
+    else:
+        out.append(ref_content)
+    out.append(TAG)
+
+MARKDOWN_RENDERERS = {
+    mwparserfromhell.nodes.Text: markdown_text_node,
+    mwparserfromhell.nodes.Template: render_template_node,
+    mwparserfromhell.nodes.Wikilink: markdown_wikilink,
+    mwparserfromhell.nodes.ExternalLink: markdown_external_link,
+    mwparserfromhell.nodes.Heading: markdown_heading,
+    mwparserfromhell.nodes.Tag: markdown_tag,
+}
+
+def finish_markdown(markdown):
+    """
+    Escape and lay out the marked up text the way html2text writes out the text of the html.
+    Each run of text is escaped and has its whitespace collapsed to one space, a run starting with whitespace is
+    separated from the one before by a space, and headings get a blank line either side.
+    Nothing else breaks a paragraph, the html had no <p>.
+    """
+    out = []
+    start = True
+    space = False
+    block = False
+    for part in MARKUP.split(markdown):
+        if part == BLOCK:
+            block = True
+            continue
+        if part == TAG:
+            continue
+        for i, text in enumerate(ENTITY_CHARS.split(part)):
+            if not text:
+                continue
+            if not i % 2:
+                # as html2text does, escape what markdown would read as list markers
+                text = WHITESPACE.sub(' ', md_escape(text))
+                if text.startswith(' '):
+                    space = True
+                    text = text[1:]
+                    if not text:
+                        continue
+            if start:
+                # nothing goes before the first text
+                start = space = block = False
+            if block:
+                out.append('\n\n')
+                space = block = False
+            if space:
+                out.append(' ')
+                space = False
+            out.append(text)
+    return ''.join(out)
+
+def format_markdown(wikitext, title):
+    """
+    Convert wikitext to markdown in one pass, what html_to_markdown(format_wikitext(wikitext), title) gives without the html in between.
+    """
+    out = []
+    for node in mwparserfromhell.parse(wikitext).nodes:
+        MARKDOWN_RENDERERS.get(type(node), markdown_node)(node, out)
+    markdown = ''.join(out)
+    if markdown == "":
+        markdown = "No content found"
+    return f"# {title}\n\n" + finish_markdown(markdown) + "\n"
+
+def read_index(f, dump_size):
+    """
+    Yield (seek, id, title, end) for every line of the multistream index.
+    end is where the next stream starts, so a page's stream is exactly dump[seek:end].
+    """
+    pending = []
+    for i, line in enumerate(f):
+        try:
+            l = line.split(':')
+            seek = int(l[0])
+            id = int(l[1])
+
+            # anything 2 onwards is the title, mash it back together
+            title = ':'.join(l[2:]).rstrip('\n')
+        except:
+            print('Failed to parse line ' + str(i) + '\n' + line, file=sys.stderr)
+            continue
+
+        # lines come in stream order, hold them until we see where their stream ends
+        if pending and pending[0][0] != seek:
+            for p in pending:
+                yield p + (seek,)
+            pending = []
+        pending.append((seek, id, title))
+
+    # the last stream runs to the end of the dump
+    for p in pending:
+        yield p + (dump_size,)
+
+def iter_batches(rows, max_bytes, op='create'):
+    """Turn index rows into lists of _bulk (action, document) lines of roughly max_bytes each, op is create or index."""
+    batch = []
+    size = 0
+    for seek, id, title, end in rows:
+        action = '{"' + op + '":{"_id":' + str(id) + '}}'
+        document = '{"title":' + json.dumps(title) + ',"seek":' + str(seek) + ',"end":' + str(end) + ',"page_id":' + str(id) + '}'
+        batch.append((action, document))
+        size += len(action) + len(document) + 2
+        if size >= max_bytes:
+            yield batch
+            batch = []
+            size = 0
+    if batch:
+        yield batch
+
+def load_checkpoint(index_filename):
+    """Return the saved ingest progress for this index file, or None if there isn't any."""
+    try:
+        with open(INDEX_CHECKPOINT) as f:
+            checkpoint = json.load(f)
+    except (OSError, ValueError):
+        return None
+    # a new index file means the old progress doesn't apply
+    stat = os.stat(index_filename)
+    if checkpoint.get('size') != stat.st_size or checkpoint.get('mtime') != stat.st_mtime:
+        return None
+    return checkpoint
+
+def save_checkpoint(index_filename, rows, batches, done=False, settings=None, overwrite=False):
+    stat = os.stat(index_filename)
+    checkpoint = {
+        'size': stat.st_size,
+        'mtime': stat.st_mtime,
+        'rows': rows,
+        'batches': batches,
+        'done': done,
+        # what the index had before the load switched refreshes and replicas off
+        'settings': settings,
+        # replace the documents already in the index instead of keeping them
+        'overwrite': overwrite
+    }
+    # write then rename so a restart never sees half a file
+    with open(INDEX_CHECKPOINT + '.tmp', 'w') as f:
+        json.dump(checkpoint, f)
+    os.replace(INDEX_CHECKPOINT + '.tmp', INDEX_CHECKPOINT)
+
+def ingest_index(index_filename, dump_size, checkpoint=None, job=None):
+    """
+    Stream the multistream index into the wikipedia index with several _bulk requests in flight.
+    Refreshes and replicas are switched off for the load and put back afterwards.
+    Progress is checkpointed after every acknowledged batch, pass the last checkpoint in to pick up where it stopped.
+    The original settings go in the checkpoint too, a load that died half way leaves the index with the load's settings
+    and the resumed one must not take those for the originals.
+    A checkpoint saved with overwrite sends index actions rather than create, so documents already there are replaced.
+    """
+    job = job or Job(None, 'ingest')
+    rows = checkpoint['rows'] if checkpoint else 0
+    batches = checkpoint['batches'] if checkpoint else 0
+    overwrite = checkpoint.get('overwrite', False) if checkpoint else False
+    job.progress(stage='ingest', done=rows)
+    if rows:
+        print('Resuming upload after ' + str(rows) + ' articles')
+
+    previous = checkpoint.get('settings') if checkpoint else None
+    if previous is None:
+        settings = get_opensearch_settings('wikipedia') or {}
+        previous = {
+            # None puts the default back
+            'refresh_interval': None if settings.get('refresh_interval') == '-1' else settings.get('refresh_interval'),
+            'number_of_replicas': settings.get('number_of_replicas')
+        }
+    # saved before anything is changed so a crash before the first batch still knows them
+    save_checkpoint(index_filename, rows, batches, settings=previous, overwrite=overwrite)
+    update_opensearch_settings({'refresh_interval': '-1', 'number_of_replicas': 0}, 'wikipedia')
+
+    try:
+        with bz2.open(index_filename, 'rt') as f, ThreadPoolExecutor(WIKI_BULK_WORKERS) as pool:
+            pending = {}  # future -> batch number
+            ends = {}  # batch number -> rows uploaded once it and every batch before it is acknowledged
+            acked = set()
+            failed = 0
+            sent = rows
+            start = time.time()
+
+            def acknowledge(done):
+                # only checkpoint the unbroken run of finished batches, later ones may finish first
+                nonlocal rows, batches, failed
+                for future in done:
+                    failed += future.result()
+                    acked.add(pending.pop(future))
+                while batches in acked:
+                    acked.remove(batches)
+                    rows = ends.pop(batches)
+                    batches += 1
+                save_checkpoint(index_filename, rows, batches, settings=previous, overwrite=overwrite)
+                job.progress(done=rows)
+
+            number = batches
+            for batch in iter_batches(islice(read_index(f, dump_size), rows, None), WIKI_BULK_BYTES, 'index' if overwrite else 'create'):
+                job.check()
+                # don't read further ahead than the senders can keep up with
+                if len(pending) >= WIKI_BULK_WORKERS * 2:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    acknowledge(done)
+                sent += len(batch)
+                ends[number] = sent
+                pending[pool.submit(bulk, 'wikipedia', batch)] = number
+                number += 1
+                print('Queued ' + str(sent) + ' articles, ' + str(int((sent - rows) / (time.time() - start + 1e-9))) + '/s')
+
+            acknowledge(wait(pending).done)
+            save_checkpoint(index_filename, rows, batches, done=True, settings=previous, overwrite=overwrite)
+            if failed:
+                job.error('Failed to upload ' + str(failed) + ' articles')
+    finally:
+        update_opensearch_settings(previous, 'wikipedia')
+        client.post(DB_URL + '/wikipedia/_refresh', idempotent=True)
+
+def render_block(seek, end, articles):
+    """
+    Render (id, title) articles from one stream to markdown, runs on the render process pool.
+    The export reads each stream once in order, so the stream is parsed into a block of its own rather than the block cache,
+    which would only fill every worker with pages that are never asked for again.
+    """
+    rendered = []
+    block = Block(WIKI_DIR + WIKI_URL.split('/')[-1], seek, end)
+    # read the stream once for all of them rather than again for every article past the last one parsed
+    block.load([int(hid) for hid, _ in articles])
+    for hid, title in articles:
+        text = get_wikitext(WIKI_DIR + WIKI_URL.split('/')[-1], seek, hid, title, end=end, block=block)
+        if text is not None:
+            text = format_markdown(text, title)
+        rendered.append((hid, title, text))
+    return rendered
+
+def export_article(manifest, knowledge_id, fileList, hid, title, name_md, text):
+    """Upload a rendered article and attach it to the knowledge base, runs on the upload thread pool. Raises if either fails."""
+    hash = hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+    entry = manifest.get(hid)
+    if entry is not None and entry['file_id'] is not None and entry['hash'] == hash:
+        # uploaded last time but never attached
+        res = {'id': entry['file_id']}
+    else:
+        # upload the markdown straight from memory
+        res = upload_file(name_md, fileList, content=text)
+        if res is None or res.get('id') is None:
+            raise Exception('Failed to upload file for article: ' + str(hid) + ' - ' + str(title))
+        manifest.uploaded(hid, name_md, hash, res['id'])
+
+    data = {
+        'file_id': res['id']
+    }
+    url = BASE_URL + 'knowledge/' + knowledge_id + '/file/add'
+    response = client.post(url, headers=auth_header(), json=data)
+    if response.status_code != 200:
+        raise Exception('Failed to add file to knowledge base for article: ' + str(hid) + ' - ' + str(title))
+    manifest.attached(hid, knowledge_id)
+
+def reconcile_manifest(manifest, knowledge_id, known):
+    """Line the manifest up with the files really in the knowledge base, returns their file names."""
+    url = BASE_URL + 'knowledge/' + knowledge_id
+    try:
+        response = client.get(url, headers=auth_header())
+        files = response.json().get('files', [])
+    except Exception as err:
+        print(f"Error checking knowledge base for existing files: {err}", file=sys.stderr)
+        return known
+    manifest.reconcile(knowledge_id, files)
+    return set(file.get('filename') for file in files)
+
+def sync_wiki(reindex=False, job=None):
+    job = job or Job(None, 'sync_wiki')
     # If we dont have wikipedia, grab it
     if not os.path.exists(WIKI_DIR):
         os.makedirs(WIKI_DIR)
@@ -327,13 +1015,28 @@ def sync_wiki(reindex=False):
         # Get the index
         os.system('wget ' + INDEX + ' -P ' + WIKI_DIR)
     # check if an index exists in opensearch
+    checkpoint = None
     if get_opensearch('wikipedia') is None:
         create_opensearch()
         reindex = True
+        # a fresh index, whatever an earlier load got through (or finished) is gone with the old one
+        save_checkpoint(WIKI_DIR + INDEX.split('/')[-1], 0, 0)
     elif reindex:
         # delete the index and recreate it
-        print(requests.delete(DB_URL + '/wikipedia'), file=sys.stderr)
+        delete_opensearch('wikipedia')
         print(create_opensearch(), file=sys.stderr)
+        save_checkpoint(WIKI_DIR + INDEX.split('/')[-1], 0, 0)
+    elif migrate_opensearch('wikipedia', job):
+        # older mappings couldn't hold seeks past 2^31, send the whole index again to fill in anything they dropped.
+        # the copied documents have no end, so they have to be overwritten rather than left alone with a 409
+        save_checkpoint(WIKI_DIR + INDEX.split('/')[-1], 0, 0, overwrite=True)
+        checkpoint = load_checkpoint(WIKI_DIR + INDEX.split('/')[-1])
+        reindex = True
+    else:
+        # pick up an upload that was interrupted, resending a batch is harmless with create or index
+        checkpoint = load_checkpoint(WIKI_DIR + INDEX.split('/')[-1])
+        if checkpoint is not None and not checkpoint['done']:
+            reindex = True
     
     while get_opensearch('wikipedia') is None:
         print('Waiting for wikipedia index')
@@ -341,58 +1044,14 @@ def sync_wiki(reindex=False):
 
     if reindex:
         # upload the index into opensearch
-        with bz2.open(WIKI_DIR + INDEX.split('/')[-1], 'rt') as f:
-            chunk = []
-            i = 0
-            c = 0
-            length = len(f.readlines())
-            f.seek(0)
-            print('Uploading ' + str(length // 1000) + ' chunks')
-            for line in f:
-                
-                try:
-                    l = line.split(':')
-                    seek = int(l[0])
-                    id = int(l[1])
-
-                    # anything 2 onwards is the title, mash it back together
-                    title = ':'.join(l[2:])
-                except:
-                    print('Failed to parse line ' + str(i) + '\n' + line, file=sys.stderr)
-                    continue
-                    
-                # Add the create action and document to the chunk
-                chunk.append(json.dumps({"create": {"_id": id}}))
-                chunk.append(json.dumps({"title": title, "seek": seek}))
-                
-                if len(chunk) > 1000 * 2:
-                    print('Uploading chunk ' + str(c + 1) + ' of ' + str(length // 1000))
-                    bulk_data = '\n'.join(chunk) + '\n'
-                    headers = {
-                        'Content-Type': 'application/json'
-                    }
-                    response = requests.post(DB_URL + '/wikipedia/_bulk', data=bulk_data, headers=headers)
-                    if response.status_code != 200:
-                        print(response.json(), file=sys.stderr)
-                        raise Exception('Failed to upload chunk: ' + str(response))
-                    chunk = []
-                    c += 1
-
-                i += 1
-
-        # Upload the last chunk
-        bulk_data = '\n'.join(chunk) + '\n'
-        headers = {
-            'Content-Type': 'application/json'
-        }
-        response = requests.post(DB_URL + '/wikipedia/_bulk', data=bulk_data, headers=headers)
-        if response.status_code != 200:
-            print(response.json(), file=sys.stderr)
-            raise Exception('Failed to upload chunk: ' + str(response))
-        
-        requests.post(DB_URL + '/_refresh')
-    
+        ingest_index(WIKI_DIR + INDEX.split('/')[-1], os.path.getsize(WIKI_DIR + WIKI_URL.split('/')[-1]), checkpoint, job)
         print('Finished uploading')
+
+    if reindex or not os.path.exists(REDIRECT_DB):
+        build_redirects(WIKI_DIR + WIKI_URL.split('/')[-1], WIKI_DIR + INDEX.split('/')[-1], job=job)
+
+    if reindex or not os.path.exists(TITLE_INDEX):
+        build_title_index(WIKI_DIR + INDEX.split('/')[-1], os.path.getsize(WIKI_DIR + WIKI_URL.split('/')[-1]), job=job)
     
     # add files to knowledge
     # create a knowledge if it doesnt exist
@@ -410,96 +1069,97 @@ def sync_wiki(reindex=False):
         knowledge = create_knowledge(name, '')
         id = knowledge['id']
 
+    manifest = Manifest(WIKI_MANIFEST)
+    known = reconcile_manifest(manifest, id, set())
     fileList = get_all_files()
     print('Adding files to knowledge base: ' + name, file=sys.stderr)
-    page = 0
-    done = False
-    while not done:
-        # get the next page of wikipedia articles
-        page += 1
-        
-        results = wiki_search(search_term='', page=page, size=99).json().get('hits', {}).get('hits', [])
+    job.progress(stage='export', total=count_wiki())
 
-        tries = 3
-        while len(results) == 0 and tries > 0:
-            results = wiki_search(search_term='', page=page, size=99).json().get('hits', {}).get('hits', [])
-            tries -= 1
+    # decompress + render on a process pool, upload + attach on a thread pool
+    # each stage only takes on so much more than it has workers for, so a slow stage holds the one before it back
+    # forkserver rather than fork, a fork of this process could inherit a lock some other thread was holding
+    # and hang on it, render_block and everything it uses is importable from wiki so nothing needs to be inherited
+    with ProcessPoolExecutor(WIKI_RENDER_WORKERS, mp_context=multiprocessing.get_context('forkserver')) as renderers, ThreadPoolExecutor(WIKI_UPLOAD_WORKERS) as uploaders:
+        rendering = set()
+        uploading = set()
 
+        def finish_uploads(limit):
+            nonlocal uploading
+            while len(uploading) > limit:
+                done, uploading = wait(uploading, return_when=FIRST_COMPLETED)
+                for future in done:
+                    try:
+                        future.result()
+                    except Exception as err:
+                        job.error(err)
+                    job.progress(1)
+
+        def finish_renders(limit):
+            nonlocal rendering
+            while len(rendering) > limit:
+                done, rendering = wait(rendering, return_when=FIRST_COMPLETED)
+                for future in done:
+                    try:
+                        rendered = future.result()
+                    except Exception as err:
+                        job.error(err)
+                        continue
+                    for hid, title, text in rendered:
+                        name_md = title.replace('/', '_').replace(':', '_') + '.md'  # ensure filename is valid
+                        if text is None:
+                            job.error('Failed to get wikitext for article: ' + str(hid) + ' - ' + str(title))
+                            job.progress(1)
+                            continue
+                        # if this article sucks or is a redirect we don't know the target of, skip it
+                        if 'REDIRECT' in text or len(text) < 100:
+                            manifest.skipped(hid, name_md, None, id)
+                            job.progress(1)
+                            continue
+                        finish_uploads(WIKI_UPLOAD_WORKERS + WIKI_QUEUE_SIZE - 1)
+                        uploading.add(uploaders.submit(export_article, manifest, id, fileList, hid, title, name_md, text))
+
+        def submit(group):
+            finish_renders(WIKI_RENDER_WORKERS + WIKI_QUEUE_SIZE - 1)
+            rendering.add(renderers.submit(render_block, group['seek'], group['end'], group['articles']))
+
+        # walk the whole index in stream order and hand out one stream's worth of articles at a time,
+        # so each render worker decompresses a block once for all the articles in it
+        group = None
+        # the title index has the same rows in the same order without a round trip per page
+        index = open_title_index()
+        for i, hit in enumerate(index.scan() if index is not None else scan_wiki()):
+            job.check()
+            # every so often check the manifest against what Open WebUI really has
+            if i > 0 and i % WIKI_RECONCILE_EVERY == 0:
+                known = reconcile_manifest(manifest, id, known)
 
-        for hit in results:
-            seek = hit['_source']['seek']
             hid = hit['_id']
             title = hit['_source']['title']
             title = title.replace('\n', ' ').strip() 
+            name_md = title.replace('/', '_').replace(':', '_') + '.md'
 
-            # save the file to the temp file
-            filename = '/tmp/' + title.replace('/', '_').replace(':', '_') + '.md'  # ensure filename is valid
-            
-            # check if the file is already in the knowledge base by title
-            url = BASE_URL + 'knowledge/' + id
-            exists = False
-            try:
-                # check if the file already exists in the knowledge base by title
-                response = requests.get(url, headers=auth_header())
-                if response.status_code == 200:
-                    knowledge_data = response.json()
-                    # Check if a file with the same title already exists in the knowledge base
-                    for file in knowledge_data.get('files', []):
-                        if file['filename'] == title.replace('/', '_').replace(':', '_') + '.md':
-                            exists = True
-                            break
-            except Exception as err:
-                print(f"Error checking knowledge base for existing file: {err}", file=sys.stderr)
+            # check the manifest, and the knowledge base's file names for anything uploaded before we kept one
+            if manifest.done(hid, id) or name_md in known:
+                job.progress(1)
                 continue
 
-            if exists:
-                print(f"Skipping file as it already exists in the knowledge base: {title}", file=sys.stderr)
+            # get_wikitext would follow a redirect and hand back the target's text, so the check after rendering never sees it
+            if resolve_redirect(hid) is not None:
+                manifest.skipped(hid, name_md, None, id)
+                job.progress(1)
                 continue
-                
-            else:
-                # clear the files in temp
-                for temp_file in os.listdir('/tmp/'):
-                    temp_file_path = os.path.join('/tmp/', temp_file)
-                    try:
-                        if os.path.isfile(temp_file_path):
-                            os.remove(temp_file_path)
-                    except Exception as e:
-                        print(f"Error deleting temp file: {e}", file=sys.stderr)
-                with open(filename, 'w') as f:
-                    text = get_wikitext(WIKI_DIR + WIKI_URL.split('/')[-1], seek, hid, title)
-                    if text is None:
-                        print('Failed to get wikitext for article: ' + str(hid) + ' - ' + str(title), file=sys.stderr)
-                        continue
-                    text = html_to_markdown(format_wikitext(text), title)
-                    # if this article sucks or is a redirect, skip it
-                    if text is None:
-                        continue
-                    elif 'REDIRECT' in text:
-                        continue
-                    elif len(text) < 100:
-                        continue
-                    f.write(text)
-                # upload the file
-                res = upload_file(filename, fileList)
-                if res is None:
-                    print('Failed to upload file for article: ' + str(hid) + ' - ' + str(title), file=sys.stderr)
-                    continue
-            
-                else:
-                    data = {
-                        'file_id': res['id']
-                    }
-                    url = BASE_URL + 'knowledge/' + id + '/file/add'
-                    try:
-                        response = requests.post(url, headers=auth_header(), json=data)
-                        if response.status_code != 200:
-                            print('Failed to add file to knowledge base for article: ' + str(hid) + ' - ' + str(title), file=sys.stderr)
-                    except ValueError as ve:
-                        # duplicate file in the knowledge base, this can happen if the same article is uploaded multiple times
-                        continue
-                    except Exception as err:
-                        print(err, file=sys.stderr)
-        
-        requests.post(DB_URL + '/_refresh')
-    
+
+            seek = hit['_source']['seek']
+            if group is not None and group['seek'] != seek:
+                submit(group)
+                group = None
+            if group is None:
+                group = {'seek': seek, 'end': hit['_source'].get('end'), 'articles': []}
+            group['articles'].append((hid, title))
+
+        if group is not None:
+            submit(group)
+        finish_renders(0)
+        finish_uploads(0)
+
     return 'Finished syncing wikipedia'